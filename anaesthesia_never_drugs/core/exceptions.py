@@ -1,4 +1,9 @@
 
 class UnsupportedAtcLevelException(Exception):
     '''ATC levels < 2 or > 5 should not be encountered by the WHO ATC scraper'''
-    pass
\ No newline at end of file
+    pass
+
+
+class ArchiveMissException(Exception):
+    '''A request was made in replay mode that the HTTP archive holds no response for'''
+    pass
@@ -44,6 +44,17 @@ class WhoAtcForm(forms.ModelForm):  # Abstract base class
         return instance
 
 
+class WhoAtcEntryForm(forms.Form):
+    '''
+    Validates a scraped entry in memory, for the bulk ingest of a chunk
+    Level 1 entries are not scraped; roots are created as the parents of level 2
+    '''
+    name = forms.CharField(max_length=255)
+    code = forms.CharField(max_length=7)
+    level = forms.IntegerField(min_value=2, max_value=5)
+    parent = forms.CharField(max_length=7)
+
+
 class AnatomicalMainGroupForm(WhoAtcForm):
     class Meta(WhoAtcForm.Meta):
         model = AnatomicalMainGroup
@@ -0,0 +1,106 @@
+from bs4 import BeautifulSoup, SoupStrainer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import time
+from urllib.parse import urlparse, parse_qs
+
+from ...utils.atc import atc_index_url, atc_levels, parse_atc_level, parse_atc_roots
+from ...utils.http_archive import HttpArchive
+
+# The BeautifulSoup parsers replaced by the lxml ones, kept as the benchmark baseline
+
+
+def parse_atc_roots_soup(content):
+    only_id_content = SoupStrainer(id='content')
+    soup = BeautifulSoup(content, 'lxml', parse_only=only_id_content)
+    links = soup.find_all('a')[:-2]
+
+    roots = {}
+    for link in links:
+        parsed_url = urlparse(link['href'])
+        query_params = parse_qs(parsed_url.query)
+        atc_code = query_params.get('code', [None])[0]
+        roots[atc_code] = link.get_text(strip=True)
+
+    return roots
+
+
+def parse_atc_level_soup(content, atc_code):
+    level = atc_levels.get(len(atc_code))
+
+    only_id_content = SoupStrainer(id='content')
+    soup = BeautifulSoup(content, 'lxml', parse_only=only_id_content)
+    links = soup.find_all('a')[level+2:]
+    links = links[:-1] if level == 4 else links  # Adjust for level 4 formatting
+
+    children = []
+    for link in links:
+        parsed_url = urlparse(link['href'])
+        query_params = parse_qs(parsed_url.query)
+        child_atc_code = query_params.get('code', [None])[0]
+
+        if child_atc_code and len(child_atc_code) > len(atc_code):
+            children.append({
+                'code': child_atc_code,
+                'level': atc_levels.get(len(child_atc_code)),
+                'parent': atc_code,
+                'name': link.get_text(strip=True)
+            })
+
+    return children
+
+
+def get_recorded_pages(path):
+    '''Returns a list of (atc_code, content) for the ATC pages in an HTTP archive; the index page has no code'''
+    pages = []
+    for metadata, content in HttpArchive(path).iter_responses():
+        if metadata['url'].startswith(atc_index_url) and metadata['status_code'] == 200:
+            atc_code = parse_qs(urlparse(metadata['url']).query).get('code', [None])[0]
+            pages.append((atc_code, content))
+    return pages
+
+
+def parse_pages(pages, roots_parser, level_parser):
+    return [
+        roots_parser(content) if atc_code is None else level_parser(content, atc_code)
+        for atc_code, content in pages
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Compares the lxml and BeautifulSoup ATC parsers on pages recorded with HTTP_ARCHIVE_MODE=record'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='The HTTP archive to read. Defaults to HTTP_ARCHIVE_PATH')
+        parser.add_argument('--repeat', type=int, default=5, help='Passes over the recorded pages per parser')
+
+    def handle(self, *args, **options):
+        pages = get_recorded_pages(options['path'] or settings.HTTP_ARCHIVE_PATH)
+        if not pages:
+            raise CommandError('No recorded ATC pages found; record an import with HTTP_ARCHIVE_MODE=record first')
+
+        timings = {}
+        for name, roots_parser, level_parser in [
+            ('BeautifulSoup', parse_atc_roots_soup, parse_atc_level_soup),
+            ('lxml', parse_atc_roots, parse_atc_level),
+        ]:
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                results = parse_pages(pages, roots_parser, level_parser)
+            timings[name] = (time.perf_counter() - start) / (options['repeat'] * len(pages))
+            self.stdout.write(f'{name}: {timings[name] * 1000:.2f} ms per page')
+
+        # The parsers should agree on every recorded page
+        baseline = parse_pages(pages, parse_atc_roots_soup, parse_atc_level_soup)
+        mismatches = [
+            atc_code or 'index'
+            for (atc_code, _), expected, result in zip(pages, baseline, results) if expected != result
+        ]
+
+        self.stdout.write(f'Pages: {len(pages)}')
+        self.stdout.write(f'Speedup: {timings["BeautifulSoup"] / timings["lxml"]:.1f}x')
+        if mismatches:
+            examples = ', '.join(mismatches[:10])
+            self.stdout.write(self.style.WARNING(f'Parsers disagree on {len(mismatches)} pages: {examples}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Parsers agree on every page'))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from ...utils.normalise import normalise_query
+
+
+def get_hit_rate(queries, key_function):
+    '''
+    Replays a stream of (query, count) through an unbounded cache keyed by key_function
+    Returns (hit rate, number of distinct keys)
+    '''
+    keys = set()
+    requests = hits = 0
+    for query, count in queries:
+        key = key_function(query)
+        requests += count
+        hits += count - (0 if key in keys else 1)
+        keys.add(key)
+    return (hits / requests if requests else 0.0), len(keys)
+
+
+class Command(BaseCommand):
+    help = 'Compares the search cache hit rate of lowercased and normalised query keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            required=True,
+            help='A file of raw queries as typed, one request per line. '
+                 'SearchQueryLog cannot be used, as it stores queries already normalised',
+        )
+
+    def handle(self, *args, **options):
+        with open(options['file'], encoding='utf-8') as f:
+            queries = [(line.rstrip('\n'), 1) for line in f]
+
+        lower_rate, lower_keys = get_hit_rate(queries, lambda query: query.lower())
+        normalised_rate, normalised_keys = get_hit_rate(queries, normalise_query)
+
+        self.stdout.write(f'Requests: {sum(count for _, count in queries)}')
+        self.stdout.write(f'Lowercased keys: {lower_keys} distinct, hit rate {lower_rate:.1%}')
+        self.stdout.write(f'Normalised keys: {normalised_keys} distinct, hit rate {normalised_rate:.1%}')
+        self.stdout.write(f'Improvement: {normalised_rate - lower_rate:+.1%}')
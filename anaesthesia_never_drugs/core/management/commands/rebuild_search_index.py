@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models.search import SearchIndex
+from ...tasks import bump_search_generation, dispatch_search_index_rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the search index into a new table and swaps it in'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--inline', action='store_true', help='Rebuild in this process rather than across Celery workers',
+        )
+
+    def handle(self, *args, **options):
+        if not options['inline']:
+            dispatch_search_index_rebuild.delay()
+            self.stdout.write('Search index rebuild dispatched')
+            return
+
+        started_at = timezone.now().isoformat()
+        SearchIndex.create_rebuild_table()
+        for model_label, start_id, end_id in SearchIndex.get_rebuild_ranges():
+            loaded = SearchIndex.load_rebuild_rows(model_label, start_id, end_id)
+            self.stdout.write(f'{model_label} {start_id}-{end_id}: {loaded} rows loaded')
+
+        count = SearchIndex.swap_rebuild_table(started_at)
+        bump_search_generation.delay()
+        self.stdout.write(self.style.SUCCESS(f'Search index rebuilt with {count} rows'))
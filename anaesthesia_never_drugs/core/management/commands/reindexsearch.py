@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from ...models.search import SearchIndex
+from ...tasks import bump_search_generation
+
+
+class Command(BaseCommand):
+    help = 'Recomputes SearchIndex search vectors with set-based updates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every row, not only unprocessed rows')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        def report_progress(updated, total):
+            self.stdout.write(f'{updated}/{total} search vectors updated')
+
+        updated = SearchIndex.recompute_search_vectors(
+            only_unprocessed=not options['all'],
+            batch_size=options['batch_size'],
+            progress=report_progress,
+        )
+        bump_search_generation.delay()
+        self.stdout.write(self.style.SUCCESS(f'Reindexed {updated} search vectors'))
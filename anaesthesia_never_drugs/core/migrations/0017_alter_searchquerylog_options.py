@@ -0,0 +1,17 @@
+# Generated by Django 4.2.10 on 2026-10-18 21:50
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0016_searchquerylog"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="searchquerylog",
+            options={"ordering": ["-count", "query"]},
+        ),
+    ]
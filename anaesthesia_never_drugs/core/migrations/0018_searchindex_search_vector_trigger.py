@@ -0,0 +1,46 @@
+# Generated by Django 4.2.10 on 2026-10-18 21:52
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0017_alter_searchquerylog_options"),
+    ]
+
+    operations = [
+        # Postgres computes search_vector whenever a row is inserted or its name or content change
+        migrations.RunSQL(
+            sql="""
+            CREATE OR REPLACE FUNCTION core_searchindex_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector :=
+                    setweight(to_tsvector('english', COALESCE(NEW.name, '')), 'A') ||
+                    setweight(to_tsvector('english', COALESCE(NEW.content, '')), 'B');
+                NEW.search_vector_processed := true;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER core_searchindex_search_vector_trigger
+            BEFORE INSERT OR UPDATE OF name, content ON core_searchindex
+            FOR EACH ROW EXECUTE FUNCTION core_searchindex_search_vector_update();
+            """,
+            reverse_sql="""
+            DROP TRIGGER IF EXISTS core_searchindex_search_vector_trigger ON core_searchindex;
+            DROP FUNCTION IF EXISTS core_searchindex_search_vector_update();
+            """
+        ),
+        # Backfill existing rows in one statement
+        migrations.RunSQL(
+            sql="""
+            UPDATE core_searchindex SET
+                search_vector =
+                    setweight(to_tsvector('english', COALESCE(name, '')), 'A') ||
+                    setweight(to_tsvector('english', COALESCE(content, '')), 'B'),
+                search_vector_processed = true;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.10 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0018_searchindex_search_vector_trigger"),
+    ]
+
+    operations = [
+        # Keep the most recent row for each object
+        migrations.RunSQL(
+            sql="""
+            DELETE FROM core_searchindex a
+            USING core_searchindex b
+            WHERE a.content_type_id = b.content_type_id
+              AND a.object_id = b.object_id
+              AND a.id < b.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        # Replaced by the index of the unique constraint
+        migrations.RunSQL(
+            sql="DROP INDEX IF EXISTS idx_searchindex_content_type_id_object_id;",
+            reverse_sql="CREATE INDEX idx_searchindex_content_type_id_object_id ON core_searchindex (content_type_id, object_id);",
+        ),
+        migrations.AddConstraint(
+            model_name="searchindex",
+            constraint=models.UniqueConstraint(
+                fields=("content_type", "object_id"), name="unique_search_index_object"
+            ),
+        ),
+    ]
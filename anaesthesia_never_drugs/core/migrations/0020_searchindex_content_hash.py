@@ -0,0 +1,28 @@
+# Generated by Django 4.2.10 on 2026-10-18 10:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0019_searchindex_unique_search_index_object"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="searchindex",
+            name="content_hash",
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        # Backfill with the same payload as SearchIndex.get_content_hash
+        migrations.RunSQL(
+            sql="""
+            UPDATE core_searchindex SET content_hash = md5(
+                COALESCE(name, '') || chr(31) || COALESCE(content, '') || chr(31) ||
+                CASE WHEN searchable THEN '1' ELSE '0' END
+            );
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
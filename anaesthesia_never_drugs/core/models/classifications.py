@@ -2,8 +2,12 @@ from django.db import models, transaction
 from django.db.models import F
 from django.utils import timezone
 from django.core.cache import cache
+from collections import defaultdict
 import logging
 
+from ..utils.deferred_indexing import defer_instance, deferred_indexing
+from ..utils.local_cache import lookup_cache
+
 logger = logging.getLogger(__name__)
 
 # Implementation of the Anatomical Therapeutic Chemical (ATC) Classification System
@@ -18,18 +22,28 @@ class AtcImport(models.Model):
     @classmethod
     def get_latest_import(cls):
         # Cached as may be frequently called with bulk updates
+        # The process-local cache avoids a network round trip for every call
+        # Its key includes the SearchIndex generation, which is bumped when an import activates
+        from .search import SearchIndex
+
         cache_key = f'{cls.__name__}_get_latest_import'
+        local_key = (cache_key, SearchIndex.get_generation())
+        result = lookup_cache.get(local_key)
+        if result is not None:
+            return result
+
         result = cache.get(cache_key)
 
         if result is None:
-            logger.info(f'Cache miss for {cache_key}')
+            logger.debug(f'Cache miss for {cache_key}')
             result = cls.objects.filter(active=True).order_by('-timestamp').first()
             if result:
                 cache.set(cache_key, result, 60*5)  # Cache for 5 minutes
-                logger.info(f'Cache set for {cache_key}')
-        else:
-            logger.info(f'Cache hit for {cache_key}')
-        
+                logger.debug(f'Cache set for {cache_key}')
+
+        if result:
+            lookup_cache.set(local_key, result)
+
         return result
     
     @classmethod
@@ -37,11 +51,17 @@ class AtcImport(models.Model):
         cache_key = f'{cls.__name__}_get_latest_import' 
         cache.delete(cache_key)
         logger.info(f'Cache invalidated for {cache_key}')
-    
-    
-    def increment_element_inserted_count(self):
-        self.elements_inserted = F('elements_inserted')+1
-        self.save()
+
+    @staticmethod
+    def bump_search_generation():
+        # Processes drop their local caches when the generation changes
+        # Called once the activation has been committed
+        from .search import SearchIndex
+        SearchIndex.bump_generation()
+
+    def increment_element_inserted_count(self, count=1):
+        # A single UPDATE of the counter; save() would rerun the activation side effects
+        AtcImport.objects.filter(pk=self.pk).update(elements_inserted=F('elements_inserted')+count)
 
     def trigger_drug_updates(self):
         # Update Drug objects associated with this AtcImport
@@ -53,6 +73,7 @@ class AtcImport(models.Model):
             if self.active:  # Ensure only 1 active AtcImport
                 AtcImport.objects.exclude(pk=self.pk).update(active=False)
                 self.invalidate_get_latest_import_cache()
+                transaction.on_commit(self.bump_search_generation)
                 self.trigger_drug_updates()
 
             super().save(*args, **kwargs)
@@ -92,6 +113,73 @@ class WhoAtc(models.Model):
                   5: ChemicalSubstance,
                   }
         return models.get(level)
+
+    @staticmethod
+    def get_parent_ids(level, parent_codes, atc_import, root_name=None):
+        '''
+        Returns a dictionary of code:pk for the parents of entries at level
+        Missing parents are created as placeholders, named when their own entry is written
+        ATC roots are not scraped, so they are named root_name here
+        '''
+        ParentModel = WhoAtc.get_model_by_level(level - 1)
+        queryset = ParentModel.objects.filter(atc_import=atc_import, code__in=parent_codes)
+        parent_ids = dict(queryset.values_list('code', 'pk'))
+
+        missing_codes = sorted(set(parent_codes) - parent_ids.keys())
+        if missing_codes:
+            name = root_name if level == 2 else None
+            ParentModel.objects.bulk_create(
+                [ParentModel(code=code, name=name, atc_import=atc_import) for code in missing_codes],
+                ignore_conflicts=True,  # Another chunk may create the same parent concurrently
+            )
+            parent_ids = dict(queryset.values_list('code', 'pk'))
+
+        return parent_ids
+
+    @staticmethod
+    def bulk_upsert(entries, atc_import, root_name=None):
+        '''
+        Writes validated entries a level at a time, parents first, so entries can parent others in the same chunk
+        Each level costs one parent lookup and one INSERT ... ON CONFLICT (code, atc_import) DO UPDATE
+        Returns the number of entries written
+        '''
+        entries_by_level = defaultdict(dict)
+        for entry in entries:
+            entries_by_level[entry['level']][entry['code']] = entry  # A repeated code keeps its last entry
+
+        for level in sorted(entries_by_level):
+            # Rows are written in code order, so concurrent chunks lock shared rows in the same order
+            level_entries = [entries_by_level[level][code] for code in sorted(entries_by_level[level])]
+            parent_codes = {entry['parent'] for entry in level_entries}
+            parent_ids = WhoAtc.get_parent_ids(level, parent_codes, atc_import, root_name)
+
+            AtcModel = WhoAtc.get_model_by_level(level)
+            AtcModel.objects.bulk_create(
+                [
+                    AtcModel(
+                        code=entry['code'],
+                        name=entry['name'],
+                        parent_id=parent_ids[entry['parent']],
+                        atc_import=atc_import,
+                    )
+                    for entry in level_entries
+                ],
+                update_conflicts=True,
+                unique_fields=['code', 'atc_import'],
+                update_fields=['name', 'parent'],
+            )
+
+        # bulk_create does not send post_save, so Drug updates are queued here
+        # They only apply to the latest AtcImport; others update Drugs on activation
+        if 5 in entries_by_level and atc_import == AtcImport.get_latest_import():
+            with deferred_indexing():
+                chemical_substances = ChemicalSubstance.objects.filter(
+                    atc_import=atc_import, code__in=entries_by_level[5],
+                )
+                for pk in chemical_substances.values_list('pk', flat=True):
+                    defer_instance(ChemicalSubstance, pk)
+
+        return sum(len(level_entries) for level_entries in entries_by_level.values())
     
     def __str__(self):
         return f'{self.name} - ATC code {self.code}'
@@ -148,34 +236,49 @@ class ChemicalSubstance(WhoAtc):
             end = min(start + batch_size, total)
             yield queryset[start:end]
 
+    def create_or_update_drug(self):
+        ChemicalSubstance.create_or_update_drugs([self])
+
     @staticmethod
-    def _update_search_index(drug):
+    def create_or_update_drugs(chemical_substances):
+        '''
+        Adds each ChemicalSubstance to the Drugs sharing its name (case insensitive)
+        Creates a Drug for names with no match
+        Costs one Drug lookup, one INSERT of new Drugs and one INSERT ... ON CONFLICT DO NOTHING of categories
+        '''
+        from django.contrib.contenttypes.models import ContentType
+        from django.db.models.functions import Upper
+        from .drugs import Drug, DrugCategory
         from .search import SearchIndex
 
-        SearchIndex.update_or_create_index(drug, search_vector_processed=False)
+        chemical_substances = list(chemical_substances)
+        names = {}
+        for chemical_substance in chemical_substances:
+            names.setdefault(chemical_substance.name.upper(), chemical_substance.name)  # The first name is kept
 
-    def create_or_update_drug(self):
-        from .drugs import Drug
+        # Account for multiple matches
+        drugs_by_name = defaultdict(list)
+        for drug in Drug.objects.annotate(upper_name=Upper('name')).filter(upper_name__in=names):
+            drugs_by_name[drug.upper_name].append(drug)
 
-        # Filter by name (case insensitive)
-        drugs = Drug.objects.filter(name__iexact=self.name)
+        # Create a new drug for each name without one
+        new_drugs = Drug.objects.bulk_create(
+            [Drug(name=name) for upper_name, name in names.items() if upper_name not in drugs_by_name]
+        )
+        for drug in new_drugs:
+            drugs_by_name[drug.name.upper()].append(drug)
 
-        # Account for multiple matches
-        if drugs.exists():
-            for drug in drugs:
-                # Add current category
-                drug.atc_category.add(self)
-                
-                # Required as M2M adds do not call save() and signals are not triggered
-                self._update_search_index(drug)
-
-        else:
-            # Create a new drug if none exists
-            drug = Drug.objects.create(name=self.name)
-            drug.atc_category.add(self)
-            
-            # Required as M2M adds do not call save() and signals are not triggered
-            self._update_search_index(drug)
+        # Categories have no fields to update, so existing rows are left as they are
+        drug_categories = [
+            DrugCategory(drug=drug, category=chemical_substance)
+            for chemical_substance in chemical_substances
+            for drug in drugs_by_name[chemical_substance.name.upper()]
+        ]
+        DrugCategory.objects.bulk_create(drug_categories, ignore_conflicts=True)
+
+        # Required as bulk creates do not call save() and signals are not triggered
+        drug_ids = {drug_category.drug.pk for drug_category in drug_categories}
+        SearchIndex.mark_dirty_ids(ContentType.objects.get_for_model(Drug), sorted(drug_ids))
 
     def __str__(self):
         return f'{self.name} - ATC code {self.code}'
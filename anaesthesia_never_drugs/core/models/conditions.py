@@ -2,6 +2,11 @@ from django.db import models, transaction
 from django.db.models import F
 from django.utils import timezone
 from django.core.cache import cache
+import logging
+
+from ..utils.local_cache import lookup_cache
+
+logger = logging.getLogger(__name__)
 
 # Implementation of Orphanet clinical entities database
 
@@ -14,24 +19,45 @@ class OrphaImport(models.Model):
     @classmethod
     def get_latest_import(cls):
         # Cached as may be frequently called with bulk updates
+        # The process-local cache avoids a network round trip for every call
+        # Its key includes the SearchIndex generation, which is bumped when an import activates
+        from .search import SearchIndex
+
         cache_key = f'{cls.__name__}_get_latest_import'
+        local_key = (cache_key, SearchIndex.get_generation())
+        result = lookup_cache.get(local_key)
+        if result is not None:
+            return result
+
         result = cache.get(cache_key)
 
         if result is None:
+            logger.debug(f'Cache miss for {cache_key}')
             result = cls.objects.filter(active=True).order_by('-timestamp').first()
             if result:
                 cache.set(cache_key, result, 60*5)  # Cache for 5 minutes
-        
+                logger.debug(f'Cache set for {cache_key}')
+
+        if result:
+            lookup_cache.set(local_key, result)
+
         return result
     
     @classmethod
     def invalidate_get_latest_import_cache(cls):
         cache_key = f'{cls.__name__}_get_latest_import' 
         cache.delete(cache_key)
-    
-    def increment_element_inserted_count(self):
-        self.elements_inserted = F('elements_inserted')+1
-        self.save()
+
+    @staticmethod
+    def bump_search_generation():
+        # Processes drop their local caches when the generation changes
+        # Called once the activation has been committed
+        from .search import SearchIndex
+        SearchIndex.bump_generation()
+
+    def increment_element_inserted_count(self, count=1):
+        # A single UPDATE of the counter; save() would rerun the activation side effects
+        OrphaImport.objects.filter(pk=self.pk).update(elements_inserted=F('elements_inserted')+count)
 
     def trigger_condition_updates(self):
         # Update Condition objects associated with this OrphaImport
@@ -43,6 +69,7 @@ class OrphaImport(models.Model):
             if self.active:  # Ensure only 1 active
                 OrphaImport.objects.exclude(pk=self.pk).update(active=False)
                 self.trigger_condition_updates()
+                transaction.on_commit(self.bump_search_generation)
             self.invalidate_get_latest_import_cache()
             super().save(*args, **kwargs)
 
@@ -60,16 +87,39 @@ class OrphaEntry(models.Model):
     status = models.CharField(max_length=255)
 
     def create_or_update_condition(self):
-        defaults = {'name': self.name,
-                    'description': self.description,
-                    'date_updated': self.date_updated,
-                    'status': self.status,}
-        condition, created = Condition.objects.update_or_create(
-            orpha_code=self.orpha_code,
-            defaults=defaults
+        OrphaEntry.create_or_update_conditions([self])
+
+    @staticmethod
+    def create_or_update_conditions(orpha_entries):
+        '''
+        Writes a Condition for each OrphaEntry with one INSERT ... ON CONFLICT (orpha_code) DO UPDATE
+        '''
+        from django.contrib.contenttypes.models import ContentType
+        from .search import SearchIndex
+
+        conditions = {}
+        for orpha_entry in orpha_entries:
+            conditions[orpha_entry.orpha_code] = Condition(  # A repeated code keeps its last entry
+                orpha_code=orpha_entry.orpha_code,
+                name=orpha_entry.name,
+                description=orpha_entry.description,
+                date_updated=orpha_entry.date_updated,
+                status=orpha_entry.status,
+            )
+        if not conditions:
+            return
+
+        # Rows are written in code order, so concurrent chunks lock shared rows in the same order
+        Condition.objects.bulk_create(
+            [conditions[orpha_code] for orpha_code in sorted(conditions)],
+            update_conflicts=True,
+            unique_fields=['orpha_code'],
+            update_fields=['name', 'description', 'date_updated', 'status'],
         )
 
-        return condition, created
+        # bulk_create does not send post_save, and does not set primary keys on conflicting rows
+        condition_ids = Condition.objects.filter(orpha_code__in=conditions).values_list('pk', flat=True)
+        SearchIndex.mark_dirty_ids(ContentType.objects.get_for_model(Condition), condition_ids)
 
     def __str__(self):
         return self.name
@@ -89,6 +139,16 @@ class Condition(models.Model):
                 'content': self.description,
                 'searchable': self.searchable}
 
+    @staticmethod
+    def get_search_index_queryset():
+        # The SQL equivalent of get_search_index_data, used to rebuild the index in bulk
+        return Condition.objects.values(
+            index_object_id=F('pk'),
+            index_name=F('name'),
+            index_content=F('description'),
+            index_searchable=F('searchable'),
+        )
+
     def __str__(self):
         return self.name
 
@@ -1,4 +1,7 @@
+from django.contrib.postgres.aggregates import StringAgg
 from django.db import models
+from django.db.models import Case, F, Q, When, Value as V
+from django.db.models.functions import Coalesce, Concat
 
 from . import classifications
 
@@ -9,6 +12,9 @@ class Drug(models.Model):
     atc_category = models.ManyToManyField(classifications.ChemicalSubstance, through='DrugCategory')
     searchable = models.BooleanField(default=True)
 
+    # Prefetched when index rows are rebuilt in bulk
+    SEARCH_INDEX_PREFETCH = ('drug_categories__category__parent',)
+
     def get_category_parents(self):
         chemical_substances = self.atc_category.all()
         parent = classifications.ChemicalTherapeuticPharmacologicalSubgroup 
@@ -26,10 +32,20 @@ class Drug(models.Model):
 
         return related_drugs
     
+    @staticmethod
+    def get_category_label(parent):
+        # Placeholder parents created by a bulk upsert have no name until their own entry is imported
+        if parent.name is None:
+            return f'ATC code {parent.code}'
+        return str(parent)
+
     def get_categories(self):
+        # Ordered by DrugCategory, and categories without a parent skipped, as in get_search_index_queryset
         content = []
-        for category in self.atc_category.all():
-            content.append(str(category.parent))
+        for drug_category in sorted(self.drug_categories.all(), key=lambda drug_category: drug_category.pk):
+            parent = drug_category.category.parent
+            if parent is not None:
+                content.append(Drug.get_category_label(parent))
         return ', '.join(content)
     
     def get_search_index_data(self):
@@ -38,6 +54,36 @@ class Drug(models.Model):
                 'content': self.get_categories(),
                 'searchable': self.searchable}
 
+    @staticmethod
+    def get_search_index_queryset():
+        # The SQL equivalent of get_search_index_data, used to rebuild the index in bulk
+        category_parent = Case(
+            When(
+                drug_categories__category__parent__name__isnull=True,
+                then=Concat(V('ATC code '), 'drug_categories__category__parent__code'),
+            ),
+            default=Concat(
+                'drug_categories__category__parent__name',
+                V(' - ATC code '),
+                'drug_categories__category__parent__code',
+            ),
+        )
+        return Drug.objects.values(
+            index_object_id=F('pk'),
+            index_name=F('name'),
+            index_content=Coalesce(
+                StringAgg(
+                    category_parent,
+                    delimiter=', ',
+                    filter=Q(drug_categories__category__parent__isnull=False),
+                    ordering='drug_categories__id',
+                ),
+                V(''),
+                output_field=models.TextField(),
+            ),
+            index_searchable=F('searchable'),
+        )
+
     def __str__(self):
         return self.name
 
@@ -76,6 +122,16 @@ class DrugAlias(models.Model):
         return {'name': self.name,
                 'content': '',
                 'searchable': self.searchable}
+
+    @staticmethod
+    def get_search_index_queryset():
+        # The SQL equivalent of get_search_index_data, used to rebuild the index in bulk
+        return DrugAlias.objects.values(
+            index_object_id=F('pk'),
+            index_name=F('name'),
+            index_content=V(''),
+            index_searchable=F('searchable'),
+        )
     
     def __str__(self):
         return f'{self.name} ({self.drug})'
\ No newline at end of file
@@ -1,19 +1,49 @@
-from django.db import models
-from django.db.models import Q, F, FloatField, ExpressionWrapper, Case, When, Value as V
-from django.contrib.postgres.search import SearchVectorField, SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connection, models, transaction
+from django.db.models import (
+    Q, F, Exists, FloatField, ExpressionWrapper, Func, OuterRef, Window, Count, Max, Min, Value as V,
+)
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.search import SearchVector, SearchVectorField, SearchQuery, SearchRank, TrigramSimilarity
 from django.contrib.postgres.indexes import GinIndex
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.core.cache import cache
 from django.conf import settings
+from django.utils import timezone
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import defaultdict, namedtuple
+from datetime import timedelta
 from random import randrange
+import binascii
+import hashlib
 import logging
+import re
+import time
+import redis
+
+from ..utils.bloom import BloomFilter
+from ..utils.deferred_indexing import defer_instance
+from ..utils.helpers import get_redis_client
+from ..utils.heavy_hitters import HeavyHitters
+from ..utils.local_cache import lexeme_cache, lookup_cache, negative_search_cache, search_cache
+from ..utils.normalise import hash_query, normalise_query
+from ..utils.trigrams import get_trigrams, similarity, word_pattern
 
 
 logger = logging.getLogger(__name__)
 
 
 class SearchQueryLog(models.Model):
+    # Increments are buffered in a Redis hash and flushed in bulk
+    BUFFER_KEY = 'search_query_log_buffer'
+
+    # Number of popular queries tracked and persisted
+    TOP_K = 5000
+
+    # Number of popular queries re-cached for each new SearchIndex generation
+    WARM_K = 500
+
     query = models.CharField(max_length=255, unique=True)
     count = models.PositiveIntegerField(default=1)
 
@@ -22,27 +52,160 @@ class SearchQueryLog(models.Model):
 
     @staticmethod
     def log_query(query):
-        obj, created = SearchQueryLog.objects.get_or_create(query=query)
-        if not created:
-            SearchQueryLog.objects.filter(query=query).update(count=F('count') + 1)
-        return obj
+        '''
+        Records a search with a single HINCRBY, keeping database writes off the request path
+        Counts are added to the heavy hitters structure by flush_buffer
+        '''
+        try:
+            get_redis_client().hincrby(SearchQueryLog.BUFFER_KEY, query[:255], 1)
+        except redis.RedisError as e:
+            logger.warning(f'Search query not logged: {e}')
+
+    @staticmethod
+    def get_heavy_hitters():
+        return HeavyHitters(get_redis_client(), 'search_query_heavy_hitters', k=SearchQueryLog.TOP_K)
+
+    @staticmethod
+    def flush_buffer():
+        '''
+        Moves the buffered counts into the heavy hitters structure
+        The buffer is renamed first so that searches logged during the flush are kept
+        Returns the number of distinct queries flushed
+        '''
+        redis_client = get_redis_client()
+        processing_key = f'{SearchQueryLog.BUFFER_KEY}_processing'
+
+        # A processing key left by a failed flush is retried before taking new counts
+        if not redis_client.exists(processing_key):
+            try:
+                redis_client.rename(SearchQueryLog.BUFFER_KEY, processing_key)
+            except redis.ResponseError:  # Nothing buffered
+                return 0
+
+        buffered = redis_client.hgetall(processing_key)
+        counts = {query.decode(): int(count) for query, count in buffered.items()}
+        SearchQueryLog.get_heavy_hitters().add_counts(counts)
+
+        redis_client.delete(processing_key)
+        return len(counts)
+
+    @staticmethod
+    def get_top_queries(n=None):
+        '''
+        Returns the n most common queries from the heavy hitters structure
+        Falls back to the table if the structure is empty, for example after Redis is flushed
+        '''
+        top_queries = [query for query, _ in SearchQueryLog.get_heavy_hitters().top(n)]
+        if not top_queries:
+            top_queries = list(SearchQueryLog.objects.values_list('query', flat=True)[:n or SearchQueryLog.TOP_K])
+        return top_queries
+
+    @staticmethod
+    def persist_top_queries():
+        '''
+        Replaces the table contents with the current top K queries and their estimated counts
+        Keeps the table at no more than TOP_K rows
+        Returns the number of queries persisted
+        '''
+        top = SearchQueryLog.get_heavy_hitters().top()
+        if not top:
+            return 0
+
+        queries = [query for query, _ in top]
+        counts = [count for _, count in top]
+
+        table = SearchQueryLog._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {table} (query, count)
+                SELECT * FROM unnest(%s::varchar[], %s::integer[])
+                ON CONFLICT (query) DO UPDATE SET count = EXCLUDED.count
+                ''',
+                [queries, counts],
+            )
+            cursor.execute(f'DELETE FROM {table} WHERE NOT (query = ANY(%s))', [queries])
+
+        return len(queries)
 
     def __str__(self):
         return self.query
 
 
+# A page of search results
+# estimated_total is exact unless a candidate branch reached CANDIDATE_LIMIT
+# approximate is True when the ranking was derived from the cached results of a shorter prefix
+SearchPage = namedtuple(
+    'SearchPage', ['results', 'next_page_token', 'estimated_total', 'approximate'], defaults=[False],
+)
+
 
 class SearchIndex(models.Model):
     # Indexed models should implement get_search_index_data
     INDEXED_MODELS = {'core.Drug', 'core.DrugAlias', 'core.Condition'}
 
+    # Number of candidates taken from each index before reranking
+    CANDIDATE_LIMIT = 200
+
+    # Number of ranked ids kept per query, and the default and maximum page sizes
+    RESULT_LIMIT = 100
+    PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 50
+
+    # Complete result sets of at most PREFIX_REUSE_LIMIT rows are filtered in memory for longer queries
+    # Only queries of at least PREFIX_REUSE_MIN_LENGTH characters are reused
+    PREFIX_REUSE_LIMIT = 50
+    PREFIX_REUSE_MIN_LENGTH = 4
+    PREFIX_REUSE_TIMEOUT = 60
+    # Added to the name similarity of reused rows that match every word of the query
+    PREFIX_MATCH_RANK = 0.1
+
+    # Seconds a stale search result may be served while it is refreshed,
+    # and the single-flight lock timeout and maximum wait
+    STALE_TIMEOUT = 60 * 60
+    LOCK_TIMEOUT = 30
+    LOCK_WAIT = 5
+
+    # Incremented whenever the searchable contents of the index change
+    # Search cache keys include the generation, so results never outlive the index they came from
+    # Processes check for a new generation every GENERATION_CHECK_INTERVAL seconds
+    GENERATION_CACHE_KEY = 'search_index_generation'
+    GENERATION_CHECK_INTERVAL = 5
+
+    # Objects whose index rows need rebuilding, as 'content_type_id:object_id' members of a Redis set
+    # Repeated saves of an object before the set is drained cost one index write
+    DIRTY_SET_KEY = 'search_index_dirty'
+    PROCESSING_SET_KEY = 'search_index_dirty_processing'
+    DRAIN_BATCH_SIZE = 1000
+
+    # Blue/green rebuilds load a copy of the table in primary key ranges of each indexed model
+    REBUILD_BATCH_SIZE = 20000
+    REBUILD_LOCK_KEY = 'search_index_rebuild_lock'
+    REBUILD_LOCK_TIMEOUT = 2 * 60 * 60
+
+    # A Bloom filter of name trigrams and search vector lexemes rules out queries that cannot match
+    # Each new generation adds the rows updated since the last update, re-reading BLOOM_FILTER_OVERLAP
+    # seconds so that rows committed late are not missed; deleted rows only cause false positives
+    # The whole table is read again every BLOOM_FILTER_REBUILD_INTERVAL, or once the filter is full
+    BLOOM_FILTER_CACHE_KEY = 'search_bloom_filter'
+    BLOOM_FILTER_ERROR_RATE = 0.01
+    BLOOM_FILTER_HEADROOM = 2  # Capacity as a multiple of the items found by a full build
+    BLOOM_FILTER_OVERLAP = 60 * 60
+    BLOOM_FILTER_REBUILD_INTERVAL = 24 * 60 * 60
+    BLOOM_FILTER_LOCK_TIMEOUT = 10 * 60
+
+    # Default pg_trgm.similarity_threshold, used by the % operator
+    SIMILARITY_THRESHOLD = 0.3
+
     name = models.CharField(max_length=255)
     content = models.TextField(null=True, blank=True)
+    # Maintained by a database trigger when name or content are written (migration 0018)
     search_vector = SearchVectorField(null=True)
     search_vector_processed = models.BooleanField(default=False)  # Identifies records for processing
     updated_at = models.DateTimeField(auto_now=True)
     model_name = models.CharField(max_length=255, null=True, blank=True)  # For convenience
     searchable = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=32, null=True, blank=True)  # See get_content_hash
 
     # Related object
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
@@ -54,114 +217,1063 @@ class SearchIndex(models.Model):
             GinIndex(fields=['name'], name='name_gin_trgm_idx', opclasses=['gin_trgm_ops']),
             GinIndex(fields=['search_vector']),
             ]
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id'], name='unique_search_index_object')
+        ]
         verbose_name_plural = "search indices"
 
-    @classmethod
-    def update_or_create_index(cls, related_object, search_vector_processed=False):        
-        content_type = ContentType.objects.get_for_model(related_object)
-        object_id = related_object.id
+    @staticmethod
+    def get_content_hash(name, content, searchable):
+        '''
+        Returns an md5 of the searchable payload of a row
+        Matches md5(name || chr(31) || content || chr(31) || searchable) in SQL, as used by migration 0020
+        '''
+        payload = '\x1f'.join([name or '', content or '', '1' if searchable else '0'])
+        return hashlib.md5(payload.encode()).hexdigest()
 
+    @staticmethod
+    def get_index_fields(related_object, content_type):
         # Dynamically get the fields dictionary from the related object
         # Calls lambda: {} if get_search_index_data method does not exist
         index_data = getattr(related_object, 'get_search_index_data', lambda: {})()
 
         # Prepare the data for updating or creating the SearchIndex entry
-        update_fields = {
+        fields = {
             'name': index_data.get('name', str(related_object)),
             'content': index_data.get('content', ''),
             'model_name': f"{content_type.app_label}.{content_type.model}",
             'searchable': index_data.get('searchable', False),
-            'search_vector_processed': search_vector_processed,
+            'search_vector_processed': False,
         }
+        fields['content_hash'] = SearchIndex.get_content_hash(fields['name'], fields['content'], fields['searchable'])
+        return fields
+
+    @classmethod
+    def rebuild_index_rows(cls, content_type, object_ids):
+        '''
+        Rebuilds the index rows for objects of one content type with a single upsert
+        Only rows whose content hash has changed are written
+        Rows for objects that no longer exist are deleted
+        Returns the number of rows written or deleted
+        '''
+        model = content_type.model_class()
+
+        # Indexed models may list relations used by get_search_index_data
+        prefetch = getattr(model, 'SEARCH_INDEX_PREFETCH', ())
+        objects = model.objects.filter(pk__in=object_ids).prefetch_related(*prefetch)
+        rows = [
+            cls(
+                content_type=content_type,
+                object_id=related_object.pk,
+                **cls.get_index_fields(related_object, content_type),
+            )
+            for related_object in objects
+        ]
+
+        deleted = 0
+        missing_ids = set(object_ids) - {row.object_id for row in rows}
+        if missing_ids:
+            deleted, _ = cls.objects.filter(content_type=content_type, object_id__in=missing_ids).delete()
+
+        existing_hashes = dict(
+            cls.objects.filter(
+                content_type=content_type, object_id__in=object_ids,
+            ).values_list('object_id', 'content_hash')
+        )
+        rows = [row for row in rows if existing_hashes.get(row.object_id) != row.content_hash]
+
+        cls.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=['content_type', 'object_id'],
+            update_fields=[
+                'name', 'content', 'model_name', 'searchable', 'content_hash', 'search_vector_processed', 'updated_at',
+            ],
+        )
+        return len(rows) + deleted
+
+    @staticmethod
+    def mark_dirty(instance):
+        '''
+        Queues the index row of instance to be rebuilt once the current transaction commits
+        Within deferred_indexing(), instances are queued together when the block exits
+        '''
+        if defer_instance(instance.__class__, instance.pk):
+            return
+        content_type = ContentType.objects.get_for_model(instance)  # Cached by ContentTypeManager
+        SearchIndex.mark_dirty_ids(content_type, [instance.pk])
+
+    @staticmethod
+    def mark_dirty_ids(content_type, object_ids):
+        '''
+        Queues the index rows of objects of one content type with a single SADD
+        once the current transaction commits
+        Falls back to rebuilding the rows immediately if Redis is unavailable
+        '''
+        object_ids = list(object_ids)
+        members = [f'{content_type.id}:{object_id}' for object_id in object_ids]
+        if not members:
+            return
+
+        def add_to_dirty_set():
+            try:
+                get_redis_client().sadd(SearchIndex.DIRTY_SET_KEY, *members)
+            except redis.RedisError as e:
+                logger.warning(f'Search index update not queued: {e}')
+                if SearchIndex.rebuild_index_rows(content_type, object_ids):
+                    SearchIndex.bump_generation()
+
+        transaction.on_commit(add_to_dirty_set)
+
+    @staticmethod
+    def take_dirty_members(redis_client):
+        '''
+        Returns up to DRAIN_BATCH_SIZE members to rebuild, which stay in the processing set until removed
+        Members left in the processing set by a drain that did not finish are returned first
+        Otherwise members are moved from the dirty set with SMOVE, so none are lost if the worker dies
+        '''
+        members = redis_client.srandmember(SearchIndex.PROCESSING_SET_KEY, SearchIndex.DRAIN_BATCH_SIZE)
+        if members:
+            return members
+
+        members = redis_client.srandmember(SearchIndex.DIRTY_SET_KEY, SearchIndex.DRAIN_BATCH_SIZE)
+        pipeline = redis_client.pipeline()
+        for member in members:
+            pipeline.smove(SearchIndex.DIRTY_SET_KEY, SearchIndex.PROCESSING_SET_KEY, member)
+        moved = pipeline.execute() if members else []
+        # Members moved by a concurrent drain are rebuilt by that drain
+        return [member for member, was_moved in zip(members, moved) if was_moved]
+
+    @staticmethod
+    def drain_dirty_set():
+        '''
+        Rebuilds the index rows of every object in the dirty set, DRAIN_BATCH_SIZE at a time
+        Members are moved to the processing set while they are rebuilt and removed once the rebuild has committed,
+        so objects saved during a drain are queued again and a failed drain is retried by the next one
+
+        If any rows were written or deleted, one new generation is published at the end, so cached
+        searches and fragments do not outlive the rows they were built from
+        Returns a dictionary of the number of objects drained and index rows changed
+        '''
+        redis_client = get_redis_client()
+        counts = {'drained': 0, 'changed': 0}
+
+        while True:
+            members = SearchIndex.take_dirty_members(redis_client)
+            if not members:
+                if counts['changed']:
+                    SearchIndex.bump_generation()
+                return counts
+
+            object_ids = defaultdict(list)
+            for member in members:
+                content_type_id, object_id = member.decode().split(':')
+                object_ids[int(content_type_id)].append(int(object_id))
+
+            try:
+                with transaction.atomic():
+                    for content_type_id, ids in object_ids.items():
+                        content_type = ContentType.objects.get_for_id(content_type_id)
+                        counts['changed'] += SearchIndex.rebuild_index_rows(content_type, ids)
+            except Exception:
+                if counts['changed']:  # Earlier batches were committed
+                    SearchIndex.bump_generation()
+                raise
+
+            redis_client.srem(SearchIndex.PROCESSING_SET_KEY, *members)
+            counts['drained'] += len(members)
+
+    @staticmethod
+    def get_search_vector():
+        '''Matches the expression used by the search_vector trigger'''
+        return (
+            SearchVector('name', weight='A', config='english') +
+            SearchVector('content', weight='B', config='english')
+        )
 
-        search_index, created = cls.objects.update_or_create(
-            content_type=content_type,
-            object_id=object_id,
-            defaults=update_fields
+    @staticmethod
+    def recompute_search_vectors(only_unprocessed=True, batch_size=5000, progress=None):
+        '''
+        Recomputes search vectors with one UPDATE per window of batch_size primary keys
+        Windows are found by keyset on id, so no ids are sent to or from the database
+
+        progress is called with (rows updated, total rows) after each window
+        Returns the number of rows updated
+        '''
+        queryset = SearchIndex.objects.all()
+        if only_unprocessed:
+            queryset = queryset.filter(search_vector_processed=False)
+
+        total = queryset.count()
+        updated = 0
+        last_id = 0
+        while True:
+            window = queryset.filter(id__gt=last_id)
+
+            # The last id in the window, or None if fewer than batch_size rows remain
+            window_ends = list(window.order_by('id').values_list('id', flat=True)[batch_size - 1:batch_size])
+            window_end = window_ends[0] if window_ends else None
+            if window_end is not None:
+                window = window.filter(id__lte=window_end)
+
+            count = window.update(
+                search_vector=SearchIndex.get_search_vector(), search_vector_processed=True, updated_at=timezone.now(),
+            )
+            updated += count
+            if progress is not None:
+                progress(updated, total)
+
+            if window_end is None:
+                return updated
+            last_id = window_end
+
+    @staticmethod
+    def get_rebuild_table():
+        return f'{SearchIndex._meta.db_table}_rebuild'
+
+    @staticmethod
+    def get_rebuild_ranges(include_index=False):
+        '''
+        Splits every indexed model into primary key ranges of REBUILD_BATCH_SIZE
+        Returns a list of (model_label, start_id, end_id), each processed by one statement or worker
+
+        With include_index, ranges also cover the object ids of existing index rows,
+        so orphaned rows beyond the largest primary key are reached
+        '''
+        ranges = []
+        for model_label in sorted(SearchIndex.INDEXED_MODELS):
+            model = apps.get_model(model_label)
+            bounds = [model.objects.aggregate(min_id=Min('pk'), max_id=Max('pk'))]
+            if include_index:
+                bounds.append(SearchIndex.objects.filter(
+                    content_type=ContentType.objects.get_for_model(model),
+                ).aggregate(min_id=Min('object_id'), max_id=Max('object_id')))
+
+            min_ids = [bound['min_id'] for bound in bounds if bound['min_id'] is not None]
+            max_ids = [bound['max_id'] for bound in bounds if bound['max_id'] is not None]
+            if not min_ids:
+                continue
+            for start_id in range(min(min_ids), max(max_ids) + 1, SearchIndex.REBUILD_BATCH_SIZE):
+                ranges.append((model_label, start_id, start_id + SearchIndex.REBUILD_BATCH_SIZE))
+        return ranges
+
+    @staticmethod
+    def create_rebuild_table():
+        '''
+        Creates an empty copy of the table to load a rebuilt index into
+        The primary key and unique constraints are added now, so a retried load cannot duplicate rows
+        Other indexes, constraints and triggers are added after loading, by swap_rebuild_table
+        '''
+        table = SearchIndex._meta.db_table
+        rebuild_table = SearchIndex.get_rebuild_table()
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {rebuild_table}')
+            cursor.execute(f'CREATE TABLE {rebuild_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING IDENTITY)')
+            for position, (kind, name, definition) in enumerate(SearchIndex.get_table_definitions(table)):
+                if SearchIndex.is_key_definition(kind, definition):
+                    cursor.execute(
+                        f'ALTER TABLE {rebuild_table} ADD CONSTRAINT {rebuild_table}_{position} {definition}'
+                    )
+
+    @staticmethod
+    def insert_index_rows(queryset, content_type, table):
+        '''
+        Inserts index rows into table with a single INSERT ... SELECT built from a
+        get_search_index_queryset, computing vectors and content hashes in the same statement
+
+        Rows keep the id of any existing row in the live table, so cached search results stay valid
+        New rows draw ids from the live table's sequence, so ids are unique across both tables
+        Returns the number of rows inserted
+        '''
+        source_sql, source_params = queryset.query.sql_with_params()
+        live_table = SearchIndex._meta.db_table
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {table} (
+                    id, name, content, model_name, searchable, content_type_id, object_id,
+                    search_vector, search_vector_processed, content_hash, updated_at
+                )
+                SELECT
+                    COALESCE(live.id, nextval(pg_get_serial_sequence(%s, 'id'))),
+                    source.index_name,
+                    source.index_content,
+                    %s,
+                    source.index_searchable,
+                    %s,
+                    source.index_object_id,
+                    setweight(to_tsvector('english', COALESCE(source.index_name, '')), 'A') ||
+                    setweight(to_tsvector('english', COALESCE(source.index_content, '')), 'B'),
+                    true,
+                    md5(
+                        COALESCE(source.index_name, '') || chr(31) || COALESCE(source.index_content, '') || chr(31) ||
+                        CASE WHEN source.index_searchable THEN '1' ELSE '0' END
+                    ),
+                    now()
+                FROM ({source_sql}) AS source
+                LEFT JOIN {live_table} AS live
+                    ON live.content_type_id = %s AND live.object_id = source.index_object_id
+                ON CONFLICT (content_type_id, object_id) DO NOTHING
+                ''',
+                [
+                    live_table,
+                    f'{content_type.app_label}.{content_type.model}',
+                    content_type.id,
+                    *source_params,
+                    content_type.id,
+                ],
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    def load_rebuild_rows(model_label, start_id, end_id):
+        '''Copies the index rows for a primary key range of one model into the rebuild table'''
+        model = apps.get_model(model_label)
+        queryset = model.get_search_index_queryset().filter(pk__gte=start_id, pk__lt=end_id)
+        content_type = ContentType.objects.get_for_model(model)
+        return SearchIndex.insert_index_rows(queryset, content_type, SearchIndex.get_rebuild_table())
+
+    @staticmethod
+    def reconcile_range(model_label, start_id, end_id):
+        '''
+        Compares a primary key range of one model with the index using anti-joins
+        Deletes index rows whose object no longer exists, and inserts rows for objects without one
+        Returns (rows deleted, rows inserted)
+        '''
+        model = apps.get_model(model_label)
+        content_type = ContentType.objects.get_for_model(model)
+        index_rows = SearchIndex.objects.filter(content_type=content_type)
+
+        deleted, _ = index_rows.filter(
+            object_id__gte=start_id, object_id__lt=end_id,
+        ).filter(
+            ~Exists(model.objects.filter(pk=OuterRef('object_id')))
+        ).delete()
+
+        missing = model.get_search_index_queryset().filter(
+            pk__gte=start_id, pk__lt=end_id,
+        ).filter(
+            ~Exists(index_rows.filter(object_id=OuterRef('pk')))
+        )
+        inserted = SearchIndex.insert_index_rows(missing, content_type, SearchIndex._meta.db_table)
+
+        return deleted, inserted
+
+    @staticmethod
+    def reconcile():
+        '''
+        Brings the index back in line with the indexed models, one primary key range at a time,
+        without loading rows into Python
+        Catches rows left behind by bulk operations, which bypass signals
+        Returns a dictionary of counts
+        '''
+        models_to_index = [apps.get_model(label) for label in SearchIndex.INDEXED_MODELS]
+        content_types = ContentType.objects.get_for_models(*models_to_index)
+        deleted, _ = SearchIndex.objects.exclude(content_type__in=content_types.values()).delete()
+        counts = {'deleted': deleted, 'inserted': 0}
+
+        for model_label, start_id, end_id in SearchIndex.get_rebuild_ranges(include_index=True):
+            range_deleted, range_inserted = SearchIndex.reconcile_range(model_label, start_id, end_id)
+            counts['deleted'] += range_deleted
+            counts['inserted'] += range_inserted
+
+        logger.info(
+            f"Search index reconciled: {counts['deleted']} orphans deleted, {counts['inserted']} rows inserted"
+        )
+        return counts
+
+    @staticmethod
+    def get_table_definitions(table):
+        '''
+        Returns the constraints, indexes and triggers of a table as (kind, name, definition)
+        Definitions come from the catalogue, so they include those created by RunSQL migrations
+        '''
+        with connection.cursor() as cursor:
+            cursor.execute(
+                '''
+                SELECT 'constraint', conname, pg_get_constraintdef(oid) FROM pg_constraint
+                WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f', 'c', 'x')
+                ORDER BY contype = 'p' DESC, conname
+                ''',
+                [table],
+            )
+            definitions = cursor.fetchall()
+
+            # Indexes not backing a constraint
+            cursor.execute(
+                '''
+                SELECT 'index', indexname, indexdef FROM pg_indexes
+                WHERE tablename = %s AND indexname NOT IN (
+                    SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass
+                )
+                ORDER BY indexname
+                ''',
+                [table, table],
+            )
+            definitions += cursor.fetchall()
+
+            cursor.execute(
+                '''
+                SELECT 'trigger', tgname, pg_get_triggerdef(oid) FROM pg_trigger
+                WHERE tgrelid = %s::regclass AND NOT tgisinternal
+                ORDER BY tgname
+                ''',
+                [table],
+            )
+            definitions += cursor.fetchall()
+
+        return definitions
+
+    @staticmethod
+    def is_key_definition(kind, definition):
+        '''Whether a table definition is a primary key or unique constraint, which the rebuild table is created with'''
+        return kind == 'constraint' and definition.startswith(('PRIMARY KEY', 'UNIQUE'))
+
+    @staticmethod
+    def swap_rebuild_table(started_at):
+        '''
+        Indexes and analyses the loaded rebuild table, then swaps it in place of the live table
+
+        Constraints, indexes and triggers are copied from the live table under temporary names,
+        and renamed once the live table is dropped
+        Rows written to the live table since started_at are copied across while it is locked,
+        so edits made during the rebuild are kept, and rows for objects deleted since they were loaded are dropped
+        Returns the number of rows in the new table
+        '''
+        table = SearchIndex._meta.db_table
+        rebuild_table = SearchIndex.get_rebuild_table()
+        definitions = SearchIndex.get_table_definitions(table)
+
+        # Build indexes after loading, which is much faster than maintaining them row by row
+        renames = []
+        with connection.cursor() as cursor:
+            for position, (kind, name, definition) in enumerate(definitions):
+                temporary_name = f'{rebuild_table}_{position}'
+                if kind == 'constraint':
+                    if not SearchIndex.is_key_definition(kind, definition):  # Keys were added by create_rebuild_table
+                        cursor.execute(f'ALTER TABLE {rebuild_table} ADD CONSTRAINT {temporary_name} {definition}')
+                    renames.append(f'ALTER TABLE {table} RENAME CONSTRAINT {temporary_name} TO {name}')
+                elif kind == 'index':
+                    definition = re.sub(
+                        r'^(CREATE (?:UNIQUE )?INDEX) \S+ ON \S+ ',
+                        rf'\1 {temporary_name} ON {rebuild_table} ',
+                        definition,
+                    )
+                    cursor.execute(definition)
+                    renames.append(f'ALTER INDEX {temporary_name} RENAME TO {name}')
+                else:
+                    definition = re.sub(
+                        r'^CREATE TRIGGER \S+ (.+?) ON \S+ ',
+                        rf'CREATE TRIGGER {temporary_name} \1 ON {rebuild_table} ',
+                        definition,
+                    )
+                    cursor.execute(definition)
+                    renames.append(f'ALTER TRIGGER {temporary_name} ON {table} RENAME TO {name}')
+
+            cursor.execute(f'ANALYZE {rebuild_table}')
+
+        columns = ', '.join(field.column for field in SearchIndex._meta.concrete_fields)
+        updates = ', '.join(
+            f'{field.column} = EXCLUDED.{field.column}'
+            for field in SearchIndex._meta.concrete_fields if not field.primary_key
         )
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Searches continue to read the live table until the swap commits
+            cursor.execute(f'LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE')
+
+            # Deleting an object deletes its live row, which a loaded range may still hold
+            for model_label in SearchIndex.INDEXED_MODELS:
+                model = apps.get_model(model_label)
+                model_table, pk_column = model._meta.db_table, model._meta.pk.column
+                cursor.execute(
+                    f'''
+                    DELETE FROM {rebuild_table} AS rebuild
+                    WHERE rebuild.content_type_id = %s AND NOT EXISTS (
+                        SELECT 1 FROM {model_table} AS object WHERE object.{pk_column} = rebuild.object_id
+                    )
+                    ''',
+                    [ContentType.objects.get_for_model(model).id],
+                )
+            cursor.execute(
+                f'''
+                INSERT INTO {rebuild_table} ({columns})
+                SELECT {columns} FROM {table} WHERE updated_at >= %s
+                ON CONFLICT (content_type_id, object_id) DO UPDATE SET {updates}
+                ''',
+                [started_at],
+            )
+            cursor.execute(f'DROP TABLE {table}')
+            cursor.execute(f'ALTER TABLE {rebuild_table} RENAME TO {table}')
+            for rename in renames:
+                cursor.execute(rename)
+
+            # New rows continue after the ids drawn from the old table's sequence
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table}",
+                [table],
+            )
+            cursor.execute(f'SELECT COUNT(*) FROM {table}')
+            count = cursor.fetchone()[0]
+
+        # Rows keep the time they were loaded, which may predate the last Bloom filter update
+        cache.delete(SearchIndex.BLOOM_FILTER_CACHE_KEY)
+
+        logger.info(f'Search index rebuilt with {count} rows')
+        return count
 
-        return search_index, created
-    
     @staticmethod
     def get_content_type(instance):
         return ContentType.objects.get_for_model(instance)
 
+    @staticmethod
+    def get_generation():
+        '''
+        Returns the current SearchIndex generation
+        Each process re-reads it from the shared cache at most every GENERATION_CHECK_INTERVAL seconds
+        If the shared cache is unavailable, the last generation seen by this process is kept
+        '''
+        local_key = SearchIndex.GENERATION_CACHE_KEY
+        generation = lookup_cache.get(local_key)
+
+        if generation is None:
+            generation = cache.get(SearchIndex.GENERATION_CACHE_KEY)
+            if generation is None:
+                if cache.add(SearchIndex.GENERATION_CACHE_KEY, 1, timeout=None):
+                    generation = 1
+                else:
+                    generation = lookup_cache.get(f'{local_key}_last_seen', 1)
+
+            lookup_cache.set(local_key, generation, timeout=SearchIndex.GENERATION_CHECK_INTERVAL)
+            lookup_cache.set(f'{local_key}_last_seen', generation, timeout=None)
+
+        return generation
+
+    @staticmethod
+    def bump_generation():
+        try:
+            generation = cache.incr(SearchIndex.GENERATION_CACHE_KEY)
+        except ValueError:  # Key does not exist yet
+            generation = 2
+            cache.set(SearchIndex.GENERATION_CACHE_KEY, generation, timeout=None)
+        lookup_cache.delete(SearchIndex.GENERATION_CACHE_KEY)
+        logger.info(f'Search index generation bumped to {generation}')
+        return generation
+
+    @staticmethod
+    def bump_generation_on_commit():
+        '''
+        Bumps the generation once when the current transaction commits, however many rows it changed
+        Outside a transaction the generation is bumped immediately
+        '''
+        pending = transaction.get_connection().run_on_commit
+        if any(callback is SearchIndex.bump_generation for _, callback, *_ in pending):
+            return
+        transaction.on_commit(SearchIndex.bump_generation)
+
+    @staticmethod
+    def get_lexeme_item(lexeme):
+        return f'lexeme:{lexeme}'
+
+    @staticmethod
+    def get_bloom_filter_items(since=None):
+        '''
+        Returns the trigrams of the names and the lexemes of the search vectors of rows updated since
+        a time, or of every row
+        '''
+        queryset = SearchIndex.objects.all()
+        where, params = '', []
+        if since is not None:
+            queryset = queryset.filter(updated_at__gte=since)
+            where, params = 'AND updated_at >= %s', [since]
+
+        items = set()
+        for name in queryset.values_list('name', flat=True).iterator(chunk_size=2000):
+            items.update(get_trigrams(name))
+
+        table = SearchIndex._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT DISTINCT unnest(tsvector_to_array(search_vector)) FROM {table} '
+                f'WHERE search_vector IS NOT NULL {where}',
+                params,
+            )
+            items.update(SearchIndex.get_lexeme_item(lexeme) for (lexeme,) in cursor)
+
+        return items
+
+    @staticmethod
+    def build_bloom_filter():
+        '''Returns a BloomFilter holding the items of every row, with room for later additions'''
+        items = SearchIndex.get_bloom_filter_items()
+        bloom_filter = BloomFilter.for_capacity(
+            len(items) * SearchIndex.BLOOM_FILTER_HEADROOM, SearchIndex.BLOOM_FILTER_ERROR_RATE,
+        )
+        for item in items:
+            bloom_filter.add(item)
+
+        logger.info(f'Search Bloom filter built with {len(items)} items')
+        return bloom_filter
+
+    @staticmethod
+    def update_bloom_filter(generation):
+        '''
+        Brings the shared Bloom filter up to the generation and returns it
+        Only the rows updated since the last update are read, unless the filter is due a full build
+        '''
+        state = cache.get(SearchIndex.BLOOM_FILTER_CACHE_KEY)
+        if state is not None and state['generation'] >= generation:
+            return state['bloom_filter']
+
+        started_at = timezone.now()
+        rebuild_before = started_at - timedelta(seconds=SearchIndex.BLOOM_FILTER_REBUILD_INTERVAL)
+        if state is None or state['built_at'] < rebuild_before or state['bloom_filter'].is_full():
+            bloom_filter = SearchIndex.build_bloom_filter()
+            built_at = started_at
+        else:
+            bloom_filter, built_at = state['bloom_filter'], state['built_at']
+            since = state['updated_at'] - timedelta(seconds=SearchIndex.BLOOM_FILTER_OVERLAP)
+            items = SearchIndex.get_bloom_filter_items(since=since)
+            for item in items:
+                bloom_filter.add(item)
+            logger.info(f'Search Bloom filter updated with {len(items)} items')
+
+        cache.set(
+            SearchIndex.BLOOM_FILTER_CACHE_KEY,
+            {'bloom_filter': bloom_filter, 'generation': generation, 'built_at': built_at, 'updated_at': started_at},
+            timeout=None,
+        )
+        return bloom_filter
+
+    @staticmethod
+    def get_bloom_filter_lock_key(generation):
+        return f'{SearchIndex.BLOOM_FILTER_CACHE_KEY}_lock_{generation}'
+
+    @staticmethod
+    def get_bloom_filter(generation):
+        '''
+        Returns the Bloom filter for the generation, or None if it has not been updated to it yet
+        A background task updates the filter; until then every query reaches the database
+        '''
+        from ..tasks import build_search_bloom_filter
+
+        local_key = (SearchIndex.BLOOM_FILTER_CACHE_KEY, generation)
+        bloom_filter = lookup_cache.get(local_key)
+
+        if bloom_filter is None:
+            state = cache.get(SearchIndex.BLOOM_FILTER_CACHE_KEY)
+            if state is None or state['generation'] < generation:
+                lock_key = SearchIndex.get_bloom_filter_lock_key(generation)
+                if cache.add(lock_key, True, timeout=SearchIndex.BLOOM_FILTER_LOCK_TIMEOUT):
+                    build_search_bloom_filter.delay(generation)
+                bloom_filter = False  # Checked again shortly rather than on every search
+                lookup_cache.set(local_key, bloom_filter, timeout=SearchIndex.GENERATION_CHECK_INTERVAL)
+            else:
+                bloom_filter = state['bloom_filter']
+                lookup_cache.set(local_key, bloom_filter)
+
+        return bloom_filter or None
+
+    @staticmethod
+    def get_query_lexemes(query):
+        '''
+        Returns the lexemes Postgres stems the query words to, as SearchQuery(query, config='english') does
+        Each process remembers the lexemes of a word, so only unseen words are sent to the database
+        '''
+        lexemes_by_word = {word: lexeme_cache.get(word) for word in query.split()}
+        missing = [word for word, lexemes in lexemes_by_word.items() if lexemes is None]
+        if missing:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT word, tsvector_to_array(to_tsvector('english', word)) FROM unnest(%s::text[]) AS word",
+                    [missing],
+                )
+                for word, lexemes in cursor:
+                    lexemes_by_word[word] = lexemes
+                    lexeme_cache.set(word, lexemes)
+
+        return {lexeme for lexemes in lexemes_by_word.values() for lexeme in lexemes}
+
+    @staticmethod
+    def is_impossible_query(query, bloom_filter):
+        '''
+        Returns True if neither candidate branch can match the query
+
+        Trigram branch: similarity is shared trigrams over the union of both trigram sets,
+        so a name can only reach SIMILARITY_THRESHOLD if at least that fraction of the query
+        trigrams occur in some name
+        Full text branch: the query matches rows holding every one of its lexemes, so each must
+        be indexed; a query of stop words only has no lexemes and matches nothing
+
+        The checks are conservative; Bloom filter false positives only send a query to the database
+        '''
+        query_trigrams = get_trigrams(query)
+        if query_trigrams:
+            shared = sum(trigram in bloom_filter for trigram in query_trigrams)
+            if shared / len(query_trigrams) >= SearchIndex.SIMILARITY_THRESHOLD - 1e-6:
+                return False
+
+        lexemes = SearchIndex.get_query_lexemes(query)
+        return not lexemes or any(SearchIndex.get_lexeme_item(lexeme) not in bloom_filter for lexeme in lexemes)
+
+    @staticmethod
+    def get_candidates(query):
+        '''
+        Phase one of a search: fetch candidate ids using operators served by the GIN indexes
+        The trigram branch uses name % query (pg_trgm.similarity_threshold, default 0.3)
+        The full text branch uses search_vector @@ query
+
+        Each branch is capped at CANDIDATE_LIMIT so that scoring never touches the whole table
+        '''
+        search_query = SearchQuery(query, config='english')
+
+        trigram_candidates = SearchIndex.objects.filter(
+            name__trigram_similar=query,
+        ).annotate(
+            similarity=TrigramSimilarity('name', query),
+        ).order_by('-similarity').values('id')[:SearchIndex.CANDIDATE_LIMIT]
+
+        vector_candidates = SearchIndex.objects.filter(
+            search_vector=search_query,
+        ).annotate(
+            rank=SearchRank(F('search_vector'), search_query),
+        ).order_by('-rank').values('id')[:SearchIndex.CANDIDATE_LIMIT]
+
+        # A UNION lets the planner join the candidates on the primary key
+        return SearchIndex.objects.filter(
+            id__in=trigram_candidates.union(vector_candidates)
+        )
+
+    @staticmethod
+    def rank_candidates(query):
+        '''
+        Phase two of a search: rerank the candidates with the combined score
+        Returns a SearchIndex queryset ordered by descending combined_score
+        '''
+        search_query = SearchQuery(query, config='english')
+        trigram_similarity = TrigramSimilarity('name', query)
+
+        # Only the candidates are scored
+        queryset = SearchIndex.get_candidates(query).annotate(
+            rank=SearchRank(F('search_vector'), search_query),
+            similarity=trigram_similarity,
+        )
+
+        # Combine rank and similarity into a single score
+        queryset = queryset.annotate(
+            combined_score=ExpressionWrapper(
+                F('rank') + F('similarity'),  # Boost exact matches
+                output_field=FloatField()
+            )
+        )
+
+        # Filter the resulting queryet
+        return queryset.filter(
+            Q(rank__gte=0.1) | Q(similarity__gte=0.3)
+        ).order_by('-combined_score')
+
+    @staticmethod
+    def get_cache_timeout():
+        '''
+        Returns the SEARCH_CACHE_TIMEOUT setting with up to 10% random jitter
+        Cache keys include the generation, so timeouts can be long without serving stale results
+        '''
+        cache_timeout = settings.SEARCH_CACHE_TIMEOUT
+        return cache_timeout - randrange(cache_timeout // 10 + 1)
+
+    @staticmethod
+    def rank(query):
+        '''
+        Runs the ranking query, keeping only the top RESULT_LIMIT rows
+        Returns the hydrated SearchIndex rows and a dictionary for the cache
+        containing the ordered ids and the total number of ranked results
+
+        The total is counted by a window function in the same query
+        As candidates are capped per index, totals above CANDIDATE_LIMIT are estimates
+        '''
+        queryset = SearchIndex.rank_candidates(query).defer('search_vector').annotate(
+            total=Window(expression=Count('id')),
+        )
+        rows = list(queryset[:SearchIndex.RESULT_LIMIT])
+
+        ranked = {
+            'ids': [row.pk for row in rows],
+            'total': rows[0].total if rows else 0,
+        }
+
+        # Small, complete result sets keep their text so longer queries can be filtered in memory
+        if len(rows) == ranked['total'] and ranked['total'] <= SearchIndex.PREFIX_REUSE_LIMIT:
+            ranked['names'] = [row.name for row in rows]
+            ranked['contents'] = [row.content or '' for row in rows]
+
+        return rows, ranked
+
+    @staticmethod
+    def get_prefix_results(query, generation):
+        '''
+        Looks for a cached result set for a shorter prefix of the query, such as 'prop' for 'propo'
+        If one is complete and small, its rows are filtered and reranked in memory, without a query
+        Returns a ranked dictionary, or None if no prefix result can be reused
+
+        Rows are kept if their name is similar to the query, as in rank_candidates, or if every word
+        of the query begins a word of their name or content, which stands in for the full text match
+        Rows the prefix did not match can still be missed, so reused results are marked approximate
+        and only kept in the process-local cache
+        '''
+        min_length = SearchIndex.PREFIX_REUSE_MIN_LENGTH
+        prefixes = [query[:length] for length in range(len(query) - 1, min_length - 1, -1)]
+        if not prefixes:
+            return None
+
+        # Check the local cache, then fetch the remaining prefixes in one round trip
+        cached = {}
+        for prefix in prefixes:
+            ranked = search_cache.get((generation, prefix))
+            if ranked is not None:
+                cached[prefix] = ranked
+        missing = {
+            SearchIndex.get_cache_keys(prefix, generation)[0]: prefix for prefix in prefixes if prefix not in cached
+        }
+        if missing:
+            for cache_key, ranked in cache.get_many(list(missing)).items():
+                cached[missing[cache_key]] = ranked
+
+        query_words = word_pattern.findall(query.lower())
+        for prefix in prefixes:  # Longest prefix first
+            ranked = cached.get(prefix)
+            if ranked is None or 'contents' not in ranked or ranked.get('approximate'):
+                continue
+
+            scored = []
+            for pk, name, content in zip(ranked['ids'], ranked['names'], ranked['contents']):
+                # Every word of the query begins a word of the row, in place of the full text match
+                words = word_pattern.findall(f'{name} {content}'.lower())
+                text_match = all(any(word.startswith(query_word) for word in words) for query_word in query_words)
+                name_similarity = similarity(name, query)
+                if text_match or name_similarity >= SearchIndex.SIMILARITY_THRESHOLD:
+                    scored.append((name_similarity + (SearchIndex.PREFIX_MATCH_RANK if text_match else 0), pk))
+            if not scored:  # Let Postgres decide that there are no results
+                return None
+            scored.sort(key=lambda item: item[0], reverse=True)  # Ties keep the prefix's order
+
+            logger.info(f'Reused results for {prefix} for query {query}')
+            return {
+                'ids': [pk for _, pk in scored],
+                'total': len(scored),
+                'fresh_until': time.time() + SearchIndex.PREFIX_REUSE_TIMEOUT,
+                'approximate': True,
+            }
+
+        return None
+
+    @staticmethod
+    def get_cache_keys(query, generation):
+        # Keys are hashed so raw user text never reaches the cache
+        query_hash = hash_query(query)
+        return f"search_results_{generation}_{query_hash}", f"search_results_lock_{generation}_{query_hash}"
+
+    @staticmethod
+    def refresh_ranked_results(query, generation):
+        '''
+        Runs the ranking query and caches the result under the given generation
+        The cached dictionary records when it stops being fresh; it is kept for STALE_TIMEOUT
+        beyond that so it can be served while a refresh runs
+        '''
+        cache_key, _ = SearchIndex.get_cache_keys(query, generation)
+        rows, ranked = SearchIndex.rank(query)
+
+        if ranked['ids']:   # Prevent cache pollution by zero result queries
+            cache_timeout = SearchIndex.get_cache_timeout()
+            ranked['fresh_until'] = time.time() + cache_timeout
+            cache.set(cache_key, ranked, timeout=cache_timeout + SearchIndex.STALE_TIMEOUT)
+
+        return rows, ranked
+
+    @staticmethod
+    def get_ranked_results(query):
+        '''
+        Returns (rows, ranked) for the query, checking the process-local cache first
+        Local entries are keyed by generation, so they are dropped when the index changes,
+        and they continue to be served if the shared cache is unavailable
+
+        Queries without results are remembered briefly in negative_search_cache, and queries
+        the Bloom filter rules out are never sent to the database
+        '''
+        generation = SearchIndex.get_generation()
+        local_key = (generation, query)
+        ranked = search_cache.get(local_key)
+        if ranked is not None and ranked.get('fresh_until', 0) >= time.time():
+            return None, ranked
+
+        # Answer queries that cannot match without touching the database
+        no_results = {'ids': [], 'total': 0}
+        if negative_search_cache.get(local_key):
+            return [], no_results
+        bloom_filter = SearchIndex.get_bloom_filter(generation)
+        if bloom_filter is not None and SearchIndex.is_impossible_query(query, bloom_filter):
+            negative_search_cache.set(local_key, True)
+            return [], no_results
+
+        # Filter a cached result set for a shorter prefix of the query if possible
+        ranked = SearchIndex.get_prefix_results(query, generation)
+        if ranked is not None:
+            search_cache.set(local_key, ranked, timeout=SearchIndex.PREFIX_REUSE_TIMEOUT)
+            return None, ranked
+
+        rows, ranked = SearchIndex.get_shared_ranked_results(query, generation)
+        if ranked['ids']:
+            search_cache.set(local_key, ranked)
+        else:
+            negative_search_cache.set(local_key, True)
+
+        return rows, ranked
+
+    @staticmethod
+    def get_shared_ranked_results(query, generation):
+        '''
+        Attempts to match the query to a result in the shared cache for this generation
+        If no match, performs the search and populates the cache
+
+        Only one process ranks a given query at a time (single-flight):
+        - A stale entry is returned immediately while a background task refreshes it
+        - On a miss, the process holding the lock ranks the query and the others wait for its result
+
+        Returns (rows, ranked): rows is None on a cache hit, otherwise the ranked SearchIndex rows
+        The cache holds only the top RESULT_LIMIT ids and the total, so its size is bounded
+        '''
+        from ..tasks import refresh_search_results
+
+        cache_key, lock_key = SearchIndex.get_cache_keys(query, generation)
+        ranked = cache.get(cache_key)
+
+        if ranked is not None:  # Cache hit
+            if ranked.get('fresh_until', 0) < time.time():
+                # Stale-while-revalidate
+                if cache.add(lock_key, True, timeout=SearchIndex.LOCK_TIMEOUT):
+                    refresh_search_results.delay(query, generation)
+            return None, ranked
+
+        # Cache miss
+        if cache.add(lock_key, True, timeout=SearchIndex.LOCK_TIMEOUT):
+            try:
+                return SearchIndex.refresh_ranked_results(query, generation)
+            finally:
+                cache.delete(lock_key)
+
+        # Another process is ranking this query
+        deadline = time.monotonic() + SearchIndex.LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            ranked = cache.get(cache_key)
+            if ranked is not None:
+                return None, ranked
+            if cache.get(lock_key) is None:  # Finished without caching a result
+                break
+
+        return SearchIndex.rank(query)
+
+    @staticmethod
+    def get_results_by_ids(result_ids):
+        '''
+        Rehydrates ranked ids with a single primary key lookup
+        Order is preserved with array_position rather than one CASE branch per id
+        '''
+        positions = Func(
+            V(list(result_ids), output_field=ArrayField(models.BigIntegerField())),
+            F('id'),
+            function='array_position',
+        )
+        return SearchIndex.objects.filter(id__in=result_ids).defer('search_vector').order_by(positions)
+
+    @staticmethod
+    def encode_page_token(position, last_id):
+        return urlsafe_b64encode(f'{position}:{last_id}'.encode()).decode()
+
+    @staticmethod
+    def decode_page_token(page_token):
+        '''Returns the (position, last_id) of a page token, or (0, None) if it is invalid'''
+        try:
+            position, last_id = urlsafe_b64decode(page_token.encode()).decode().split(':')
+            return max(int(position), 0), int(last_id)
+        except (ValueError, UnicodeDecodeError, binascii.Error):
+            return 0, None
+
     @staticmethod
     def search(query, return_result=True):
         '''
-        Attempts to match the query to a result in cache
-        If no match, performs the search and populates the cache with a random timeout
-        If a cache exists, returns this without updating the cache timeout
+        Returns the top RESULT_LIMIT results for the query, using the cache where possible
 
-        If return_result=True, returns a SearchIndex queryset
+        If return_result=True, returns the ranked SearchIndex rows, as search_page does
         Otherwise returns True if a query was processed, else False
         '''
+        # Normalise the query
+        query = normalise_query(query)
+
         # Return empty if no query
         if not query:
             return SearchIndex.objects.none() if return_result else False
-        
-        # Normalise the query
-        query = query.lower()
+
         logger.info(f'Search performed: {query}')
-        
-        # Set up the cache
-        cache_key = f"search_results_{query}"
-        result_ids = cache.get(cache_key)
-        
-        if result_ids is None: # Cache miss
-            # Randomize cache timeout to a multiple of the CACHE_TIMEOUT setting
-            cache_timeout = settings.CACHE_TIMEOUT
-            min_multiplier = 1
-            max_multiplier = 10
-            random_multiplier = randrange(min_multiplier, max_multiplier + 1)
-            
-            # Aim for expiry shortly before scheduled cache refresh
-            randomised_cache_timeout = random_multiplier * cache_timeout - 30
-
-            # Calculate the query and TrigramSimilarity
-            search_query = SearchQuery(query, config='english')
-            trigram_similarity = TrigramSimilarity('name', query)
-
-            # Apply the search to the SearchIndex
-            queryset = SearchIndex.objects.annotate(
-                rank=SearchRank(F('search_vector'), search_query),
-                similarity=trigram_similarity,
-            )
 
-            # Combine rank and similarity into a single score
-            queryset = queryset.annotate(
-                combined_score=ExpressionWrapper(
-                    F('rank') + F('similarity'),  # Boost exact matches
-                    output_field=FloatField()
-                )
-            )
-            
-            # Filter the resulting queryet
-            queryset = queryset.filter(
-                Q(rank__gte=0.1) | Q(similarity__gte=0.3)
-            ).order_by('-combined_score')
+        if return_result:
+            rows, ranked = SearchIndex.get_ranked_results(query)
 
-            # Evaluate the queryset for the cache
-            result_ids = list(queryset.values_list('id', flat=True))
+            # Cache-only searches should not be logged
+            SearchQueryLog.log_query(query)
 
-            if result_ids:   # Prevent cache pollution by zero result queries
-                # Set the new cache
-                cache.set(cache_key, result_ids, timeout=randomised_cache_timeout)
+            if rows is not None:
+                # Cache miss: the ranking query already returned hydrated rows
+                return rows
+            # Cache hit: one indexed primary key lookup
+            return SearchIndex.get_results_by_ids(ranked['ids'])
 
-        if return_result:
-            # Ensure order is preserved in the new queryset
-            preserved = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(result_ids)])
+        # For cache-only operations, populate the shared cache directly
+        SearchIndex.get_shared_ranked_results(query, SearchIndex.get_generation())
+        return True
 
-            # Reconstruct the queryset using the cached IDs
-            queryset = SearchIndex.objects.filter(id__in=result_ids).order_by(preserved)
-            
-            # Cache-only searches should not be logged
+    @staticmethod
+    def search_page(query, page_size=None, page_token=None):
+        '''
+        Returns a SearchPage of at most page_size results
+
+        Pages are keyset-style: the token records the last id returned
+        The next page starts after that id in the cached ranking, or at the recorded position
+        if the ranking has since changed
+        '''
+        page_size = max(1, min(page_size or SearchIndex.PAGE_SIZE, SearchIndex.MAX_PAGE_SIZE))
+
+        # Normalise the query
+        query = normalise_query(query)
+
+        # Return empty if no query
+        if not query:
+            return SearchPage(SearchIndex.objects.none(), None, 0)
+
+        logger.info(f'Search performed: {query}')
+
+        rows, ranked = SearchIndex.get_ranked_results(query)
+        result_ids = ranked['ids']
+
+        start = 0
+        if page_token:
+            position, last_id = SearchIndex.decode_page_token(page_token)
+            start = result_ids.index(last_id) + 1 if last_id in result_ids else position
+        else:
+            # Only the first page is logged as a query
             SearchQueryLog.log_query(query)
-            
-            return queryset
-        
-        # For cache-only operations
-        return True 
+
+        page_ids = result_ids[start:start + page_size]
+        end = start + len(page_ids)
+        next_page_token = SearchIndex.encode_page_token(end, page_ids[-1]) if end < len(result_ids) else None
+
+        if rows is not None:
+            # Cache miss: the ranking query already returned hydrated rows
+            results = rows[start:end]
+        else:
+            # Cache hit: one indexed primary key lookup
+            results = SearchIndex.get_results_by_ids(page_ids)
+
+        return SearchPage(results, next_page_token, ranked['total'], ranked.get('approximate', False))
 
     def __str__(self):
         return f'{self.model_name} - {self.name}'
\ No newline at end of file
@@ -6,6 +6,7 @@ import logging
 
 from .models.search import SearchIndex
 from .tasks import update_search_vector
+from .utils.deferred_indexing import defer_instance, register_flush
 
 from .models.classifications import AtcImport, ChemicalSubstance
 from .models.conditions import OrphaEntry, Condition, OrphaImport
@@ -17,19 +18,40 @@ Maintain SearchIndex
 logger = logging.getLogger(__name__)
 
 # Not called on bulk create/update
+# Index rows are rebuilt in bulk by drain_search_index_updates
+# Deferred within deferred_indexing()
 def update_or_create_index(sender, instance, **kwargs):
-    search_index_instance, _ = SearchIndex.update_or_create_index(instance, search_vector_processed=False)
+    SearchIndex.mark_dirty(instance)
+
+
+def make_index_flush(model):
+    def flush_index(ids):
+        SearchIndex.mark_dirty_ids(ContentType.objects.get_for_model(model), ids)
+    return flush_index
 
 # Called on bulk delete
+# The generation is bumped once per transaction, not once per deleted row
 def update_search_index_on_delete(sender, instance, **kwargs):
     content_type = ContentType.objects.get_for_model(sender)
     SearchIndex.objects.filter(content_type=content_type, object_id=instance.pk).delete()
+    SearchIndex.bump_generation_on_commit()
+
+
+# Direct writes to SearchIndex rows, such as edits in the admin
+# Bulk upserts do not send signals; drain_search_index_updates bumps the generation for those
+def bump_generation_on_index_change(sender, instance, **kwargs):
+    SearchIndex.bump_generation_on_commit()
+
+
+post_save.connect(bump_generation_on_index_change, sender=SearchIndex)
+post_delete.connect(bump_generation_on_index_change, sender=SearchIndex)
 
 # Attach signal to indexed models
 for model_label in SearchIndex.INDEXED_MODELS:
     model = apps.get_model(model_label)
     post_save.connect(update_or_create_index, sender=model)
     post_delete.connect(update_search_index_on_delete, sender=model)
+    register_flush(model, make_index_flush(model))
     logger.info(f'Connected signals for {model_label}')
 
 
@@ -39,6 +61,9 @@ Keep Drug up to date with current ChemicalSubstance
 # Create or update Drug for each ChemicalSubstance
 @receiver(post_save, sender=ChemicalSubstance)
 def create_or_update_drug_on_chemical_substance_save(sender, instance, **kwargs):
+    if defer_instance(sender, instance.pk):
+        return
+
     # Only proceed if this is the latest AtcImport
     logger.info(f'Considering drug creation for {instance}')
     if instance.atc_import == AtcImport.get_latest_import():
@@ -46,12 +71,33 @@ def create_or_update_drug_on_chemical_substance_save(sender, instance, **kwargs)
         logger.info(f'Drug created: {instance}')
 
 
+# One pass over the ChemicalSubstances saved within deferred_indexing()
+def create_or_update_drugs(ids):
+    latest_import = AtcImport.get_latest_import()
+    ChemicalSubstance.create_or_update_drugs(ChemicalSubstance.objects.filter(pk__in=ids, atc_import=latest_import))
+
+
+register_flush(ChemicalSubstance, create_or_update_drugs)
+
+
 '''
 Keep Condition up to date with current OrphaEntry
 '''
 # Create or update Condition for each OrphaEntry
 @receiver(post_save, sender=OrphaEntry)
 def create_or_update_condition_on_orpha_entry_save(sender, instance, **kwargs):
+    if defer_instance(sender, instance.pk):
+        return
+
     # Only proceed if this is the latest OrphaImport
     if instance.orpha_import == OrphaImport.get_latest_import():
-        instance.create_or_update_condition()
\ No newline at end of file
+        instance.create_or_update_condition()
+
+
+# One pass over the OrphaEntries saved within deferred_indexing()
+def create_or_update_conditions(ids):
+    latest_import = OrphaImport.get_latest_import()
+    OrphaEntry.create_or_update_conditions(OrphaEntry.objects.filter(pk__in=ids, orpha_import=latest_import))
+
+
+register_flush(OrphaEntry, create_or_update_conditions)
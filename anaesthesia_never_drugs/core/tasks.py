@@ -1,19 +1,21 @@
 from config import celery_app
+from collections import defaultdict
 from celery import chord
-from django.contrib.postgres.search import SearchVector
-from django.db import transaction, OperationalError
 from django.conf import settings
+from django.db import transaction, OperationalError
+from django.core.cache import cache
+from django.utils import timezone
 import logging
-import redis
 
-from .utils.atc import scrape_atc, scrape_atc_roots
+from .utils.atc import scrape_atc_concurrently, scrape_atc_roots
 from .utils.fda import orchestrate_fda_products_download
 from .utils.orphanet import get_latest_orphanet_json, unpack_orphanet_json_entry
-from .utils.helpers import chunk_queryset, chunk_generator, iterable_batch_generator
+from .utils.deferred_indexing import deferred_indexing
+from .utils.helpers import chunk_queryset, iterable_batch_generator
 from .models.classifications import AtcImport, WhoAtc, FdaImport, ChemicalSubstance
 from .models.conditions import OrphaImport, OrphaEntry
 from .models.search import SearchIndex, SearchQueryLog
-from .forms.drugs import FORMS_BY_LEVEL
+from .forms.drugs import WhoAtcEntryForm
 from .forms.conditions import OrphaEntryForm
 
 logger = logging.getLogger(__name__)
@@ -22,15 +24,52 @@ logger = logging.getLogger(__name__)
 
 @celery_app.task()
 def update_search_vector(search_index_pks):
-    # Calculate the SearchVector for a given SearchIndex object
-    for search_index_pk in search_index_pks:
-        SearchIndex.objects.filter(pk=search_index_pk).update(
-            search_vector=(
-                SearchVector('name', weight='A') +
-                SearchVector('content', weight='B')
-            ),
-            search_vector_processed=True,
-        )
+    # Calculate the SearchVector for the given SearchIndex objects in a single UPDATE
+    # Rows are normally kept up to date by a database trigger; this recomputes them on demand
+    return SearchIndex.objects.filter(pk__in=search_index_pks).update(
+        search_vector=SearchIndex.get_search_vector(),
+        search_vector_processed=True,
+    )
+
+
+@celery_app.task()
+def bump_search_generation(result=None):
+    '''
+    Publishes a new SearchIndex generation once vector updates are complete
+    Cached searches from earlier generations are no longer used, so common queries are re-cached
+    '''
+    SearchIndex.bump_generation()
+    cache_common_queries.delay()
+
+
+@celery_app.task(time_limit=60*60, soft_time_limit=50*60)
+def reindex_search_vectors(only_unprocessed=True):
+    '''
+    Rebuilds queued index rows and recomputes search vectors with set-based updates,
+    then bumps the generation
+    Set only_unprocessed=False to recompute every row
+    '''
+    def log_progress(updated, total):
+        logger.info(f'Search vectors updated: {updated}/{total}')
+
+    # Write any queued index rows first
+    counts = SearchIndex.drain_dirty_set()
+    logger.info(f'Search index rows rebuilt: {counts}')
+
+    updated = SearchIndex.recompute_search_vectors(only_unprocessed=only_unprocessed, progress=log_progress)
+    bump_search_generation.delay()
+    return updated
+
+
+@celery_app.task()
+def drain_search_index_updates():
+    '''
+    Rebuilds the index rows of objects saved since the last drain
+    A new generation is published if any rows changed
+    '''
+    counts = SearchIndex.drain_dirty_set()
+    logger.info(f'Search index rows rebuilt: {counts}')
+    return counts
 
 @celery_app.task()
 def dispatch_search_vector_updates(result):
@@ -39,58 +78,149 @@ def dispatch_search_vector_updates(result):
     processed = sum(result)
     logger.info(f'{batch_count} batches for {processed} objects updated')
 
-    objects_to_process = SearchIndex.objects.filter(search_vector_processed=False)
-    ids = list(objects_to_process.values_list('id', flat=True))
-    batches = iterable_batch_generator(ids, batch_size=100)
+    # The search_vector trigger marks rows as processed, so usually only the generation is bumped
+    reindex_search_vectors.delay()
+
+
+@celery_app.task()
+def dispatch_search_index_rebuild():
+    '''
+    Rebuilds the search index into a new table, loading primary key ranges in parallel,
+    then swaps it in once every range has loaded
+    Searches use the current table until the swap
+    '''
+    if not cache.add(SearchIndex.REBUILD_LOCK_KEY, True, timeout=SearchIndex.REBUILD_LOCK_TIMEOUT):
+        logger.info('Task already running - search index rebuild')
+        return
+
+    started_at = timezone.now().isoformat()
+    SearchIndex.create_rebuild_table()
+    child_tasks = [load_search_index_rebuild.s(*rebuild_range) for rebuild_range in SearchIndex.get_rebuild_ranges()]
+
+    if child_tasks:
+        chord(child_tasks)(finish_search_index_rebuild.s(started_at))
+    else:
+        finish_search_index_rebuild.delay([], started_at)
+
+
+@celery_app.task(
+    autoretry_for=(OperationalError,), retry_kwargs={'max_retries': 5, 'countdown': 60}, retry_backoff=True,
+)
+def load_search_index_rebuild(model_label, start_id, end_id):
+    loaded = SearchIndex.load_rebuild_rows(model_label, start_id, end_id)
+    logger.info(f'Loaded {loaded} {model_label} rows into the search index rebuild')
+    return loaded
+
+
+@celery_app.task(time_limit=60*60, soft_time_limit=50*60)
+def finish_search_index_rebuild(result, started_at):
+    '''Indexes the rebuilt table and swaps it in, then publishes a new generation'''
+    try:
+        logger.info(f'{sum(result)} rows loaded into the search index rebuild')
+        SearchIndex.swap_rebuild_table(started_at)
+        bump_search_generation.delay()
+    finally:
+        cache.delete(SearchIndex.REBUILD_LOCK_KEY)
+
+
+@celery_app.task(time_limit=60*60, soft_time_limit=50*60)
+def reconcile_search_index():
+    '''Removes orphaned index rows and adds missing ones, publishing a new generation if anything changed'''
+    counts = SearchIndex.reconcile()
+    if counts['deleted'] or counts['inserted']:
+        bump_search_generation.delay()
+    return counts
+
+
+@celery_app.task()
+def refresh_search_results(query, generation):
+    '''Re-ranks a stale cached query, then releases its single-flight lock'''
+    _, lock_key = SearchIndex.get_cache_keys(query, generation)
+    try:
+        SearchIndex.refresh_ranked_results(query, generation)
+    finally:
+        cache.delete(lock_key)
+
 
-    for batch in batches:
-        update_search_vector.delay(batch)
+@celery_app.task()
+def build_search_bloom_filter(generation):
+    '''Brings the Bloom filter used to rule out impossible queries up to a SearchIndex generation'''
+    try:
+        SearchIndex.update_bloom_filter(generation)
+    finally:
+        cache.delete(SearchIndex.get_bloom_filter_lock_key(generation))
+
+
+@celery_app.task()
+def flush_search_query_log():
+    '''Adds the buffered search query counts to the heavy hitters structure'''
+    flushed = SearchQueryLog.flush_buffer()
+    logger.info(f'Flushed counts for {flushed} search queries')
+
+
+@celery_app.task()
+def persist_top_search_queries():
+    '''Writes the current top K search queries to SearchQueryLog'''
+    persisted = SearchQueryLog.persist_top_queries()
+    logger.info(f'Persisted {persisted} top search queries')
 
 
 @celery_app.task(time_limit=60*60, soft_time_limit=50*60)
 def cache_common_queries():
     '''
     Determine the most common search queries, and cache the results
-    Uses a Redis distributed lock to avoid duplication by multiple workers on startup
+    Runs once per SearchIndex generation, however many workers start or bumps queue it
+    Stops early if the generation changes, as its results would no longer be used
     '''
-    number_to_cache = 5
-    000
-    
-    # Distributed lock using Redis
-    # Configure Redis connection
-    redis_client = redis.StrictRedis.from_url(settings.CELERY_BROKER_URL)
-    lock = redis_client.lock("cache_common_queries_lock", timeout=7200)  # 120 minute lock
-
-    if lock.acquire(blocking=False):
-        logger.info('Lock acquired for caching common queries')
-        try:
-            common_queries = SearchQueryLog.objects.order_by('-count')[:number_to_cache]
-            for log_object in common_queries:
-                SearchIndex.search(log_object.query, return_result=False)
-                logger.info(f'Cached query: {log_object.query}')
-        except Exception as e:
-            logger.error(f'Error during caching common queries: {e}')
-        finally:
-            lock.release()
-            logger.info('Lock released after caching common queries')
-    else:
-        logger.info('Task already running - cache common queries')
+    generation = SearchIndex.get_generation()
+
+    # cache.add is atomic, so only one worker warms each generation
+    if not cache.add(f'cache_common_queries_{generation}', True, timeout=settings.SEARCH_CACHE_TIMEOUT):
+        logger.info(f'Common queries already cached for generation {generation}')
+        return
+
+    try:
+        # Read from the heavy hitters structure rather than sorting the table
+        for query in SearchQueryLog.get_top_queries(SearchQueryLog.WARM_K):
+            if SearchIndex.get_generation() != generation:
+                logger.info(f'Generation changed, stopped caching common queries for generation {generation}')
+                break
+            SearchIndex.search(query, return_result=False)
+            logger.info(f'Cached query: {query}')
+    except Exception as e:
+        logger.error(f'Error during caching common queries: {e}')
 
 
 '''WHO ATC scraping'''
 
+ATC_CHUNK_SIZE = 20
+
 @celery_app.task(time_limit=60*60*2, soft_time_limit=59*60*2)
 def import_who_atc():
     # Create new AtcImport
     atc_import_instance = AtcImport.objects.create(active=False)
     atc_roots_dict = scrape_atc_roots()
-    
-    for root, root_name in atc_roots_dict.items():
-        # scrape_atc should be run serially
-        for chunk in chunk_generator(scrape_atc(root)):
+
+    # Pages are fetched concurrently within the politeness limits in settings
+    entries = scrape_atc_concurrently(
+        atc_roots_dict,
+        requests_per_second=settings.ATC_REQUESTS_PER_SECOND,
+        max_in_flight=settings.ATC_MAX_IN_FLIGHT,
+        parse_workers=settings.ATC_PARSE_WORKERS,
+        cache_dir=settings.ATC_HTTP_CACHE_DIR,
+        max_age=settings.ATC_HTTP_CACHE_MAX_AGE,
+    )
+
+    # Entries from different roots arrive interleaved, so chunks are buffered per root
+    chunks = defaultdict(list)
+    for root, entry in entries:
+        chunks[root].append(entry)
+        if len(chunks[root]) >= ATC_CHUNK_SIZE:
             # Each chunk is created as a separate process
-            chunk_task = process_atc_chunk.s(chunk, atc_import_instance.pk, root_name)
-            chunk_task.apply_async()
+            process_atc_chunk.s(chunks.pop(root), atc_import_instance.pk, atc_roots_dict[root]).apply_async()
+
+    for root, chunk in chunks.items():
+        process_atc_chunk.s(chunk, atc_import_instance.pk, atc_roots_dict[root]).apply_async()
 
 
 @celery_app.task(autoretry_for=(OperationalError,), retry_kwargs={'max_retries': 5, 'countdown': 60}, retry_backoff=True)
@@ -98,32 +228,21 @@ def process_atc_chunk(chunk, atc_import_pk, root_name):
     atc_import_instance = AtcImport.objects.get(pk=atc_import_pk)
     errors = []
 
-    with transaction.atomic():  # Prevent race condition between Celery workers
-        for entry in chunk:
-            # Find the correct form for this level in the hierarchy
-            level = entry['level']
-            FormClass = FORMS_BY_LEVEL.get(level)
-            
-            if FormClass:
-                # Overwrite an existing instance if it exists
-                AtcModel = WhoAtc.get_model_by_level(level)
-                code = entry['code']
-                entry_instance_queryset = AtcModel.objects.filter(code=code, atc_import=atc_import_instance).select_for_update()
-                entry_instance = entry_instance_queryset.first()
-
-                # Instantiate the form
-                form = FormClass(
-                    entry,
-                    instance=entry_instance,  # Overwrite instance if exists
-                    atc_import_instance=atc_import_instance,
-                    root_name=root_name,  # Ensure ATC root parents are named
-                    )
-                
-                if form.is_valid():
-                    form.save()
-                    atc_import_instance.increment_element_inserted_count()
-                else:
-                    errors.extend(form.errors)
+    # Validate the whole chunk in memory before writing
+    entries = []
+    for entry in chunk:
+        form = WhoAtcEntryForm(entry)
+        if form.is_valid():
+            entries.append(form.cleaned_data)
+        else:
+            errors.extend(form.errors)
+
+    # Signal work for the chunk runs once, after it is committed
+    with deferred_indexing(), transaction.atomic():
+        # Each level is upserted on (code, atc_import), so concurrent chunks cannot duplicate entries
+        inserted_count = WhoAtc.bulk_upsert(entries, atc_import_instance, root_name=root_name)
+        if inserted_count:
+            atc_import_instance.increment_element_inserted_count(inserted_count)
     
     return errors
 
@@ -135,15 +254,11 @@ def process_drug_chunk(chemical_substance_ids):
     Creates or updates a Drug object for each ChemicalSubstance passed
     SearchIndexes are also created for each Drug
     '''
-    processed_count = 0
-    for chemical_substance_id in chemical_substance_ids:
-        try:
-            chemical_substance = ChemicalSubstance.objects.get(pk=chemical_substance_id)
-            chemical_substance.create_or_update_drug()  # Calls SearchIndex.update_or_create_index()
-            processed_count += 1
-        except ChemicalSubstance.DoesNotExist:
-            continue
-    return processed_count  # Signal completion to the Chord
+    # Queues the SearchIndex updates together, once the chunk has committed
+    with deferred_indexing(), transaction.atomic():
+        chemical_substances = list(ChemicalSubstance.objects.filter(pk__in=chemical_substance_ids))
+        ChemicalSubstance.create_or_update_drugs(chemical_substances)  # Calls SearchIndex.mark_dirty_ids()
+    return len(chemical_substances)  # Signal completion to the Chord
 
 @celery_app.task(retry_kwargs={'max_retries': 5, 'countdown': 60}, retry_backoff=True)
 def dispatch_update_drug_objects(atc_import_pk, batch_size=100):
@@ -173,17 +288,24 @@ def process_orphanet_batch(batch, orpha_import_pk):
     orpha_import_instance = OrphaImport.objects.get(pk=orpha_import_pk)
 
     # Iterate over the batch
-    for condition in batch:
-        form = OrphaEntryForm(
-            unpack_orphanet_json_entry(condition),
-            orpha_import_instance=orpha_import_instance,
-        )
-
-        if form.is_valid():
-            form.save()
-            orpha_import_instance.increment_element_inserted_count()
-        else:
-            errors.extend(form.errors)
+    # Signal work for the batch runs once, after the batch has committed
+    inserted_count = 0
+    with deferred_indexing(), transaction.atomic():
+        for condition in batch:
+            form = OrphaEntryForm(
+                unpack_orphanet_json_entry(condition),
+                orpha_import_instance=orpha_import_instance,
+            )
+
+            if form.is_valid():
+                form.save()
+                inserted_count += 1
+            else:
+                errors.extend(form.errors)
+
+        # Counted once, so concurrent batches hold the OrphaImport row lock only briefly
+        if inserted_count:
+            orpha_import_instance.increment_element_inserted_count(inserted_count)
     
     return errors
 
@@ -205,15 +327,11 @@ def dispatch_orphanet_imports():
 '''Condition model updating'''
 @celery_app.task()
 def process_condition_chunk(orpha_entry_ids):
-    processed_count = 0
-    for orpha_entry_id in orpha_entry_ids:
-        try:
-            orpha_entry = OrphaEntry.objects.get(id=orpha_entry_id)
-            orpha_entry.create_or_update_condition()
-            processed_count += 1
-        except OrphaEntry.DoesNotExist:
-            continue
-    return processed_count  # Signal completion to the Chord
+    # Queues the SearchIndex updates together, once the chunk has committed
+    with deferred_indexing(), transaction.atomic():
+        orpha_entries = list(OrphaEntry.objects.filter(id__in=orpha_entry_ids))
+        OrphaEntry.create_or_update_conditions(orpha_entries)
+    return len(orpha_entries)  # Signal completion to the Chord
 
 @celery_app.task(retry_kwargs={'max_retries': 5, 'countdown': 60}, retry_backoff=True)
 def dispatch_update_condition_objects(orpha_import_pk, batch_size=100):
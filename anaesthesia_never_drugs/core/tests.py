@@ -1,3 +1,827 @@
-from django.test import TestCase
+import asyncio
+import threading
+import time
 
-# Create your tests here.
+import httpx
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.search import SearchQuery
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from anaesthesia_never_drugs.core import views
+from anaesthesia_never_drugs.core.exceptions import ArchiveMissException
+from anaesthesia_never_drugs.core.management.commands.benchmark_query_normalisation import get_hit_rate
+from anaesthesia_never_drugs.core.models.classifications import AtcImport, ChemicalSubstance, WhoAtc
+from anaesthesia_never_drugs.core.models.conditions import Condition, OrphaEntry, OrphaImport
+from anaesthesia_never_drugs.core.models.drugs import Drug, DrugCategory
+from anaesthesia_never_drugs.core.models.search import SearchIndex, SearchQueryLog
+from anaesthesia_never_drugs.core.tasks import build_search_bloom_filter, cache_common_queries, refresh_search_results
+from anaesthesia_never_drugs.core.utils.atc import (
+    AtcCrawler,
+    RateLimiter,
+    get_atc_url,
+    parse_atc_level,
+    parse_atc_roots,
+    scrape_atc_concurrently,
+)
+from anaesthesia_never_drugs.core.utils.autocomplete import Autocomplete, AutocompleteEntry, PrefixIndex
+from anaesthesia_never_drugs.core.utils.bloom import BloomFilter
+from anaesthesia_never_drugs.core.utils.deferred_indexing import defer_instance, deferred_indexing, register_flush
+from anaesthesia_never_drugs.core.utils.heavy_hitters import HeavyHitters
+from anaesthesia_never_drugs.core.utils.helpers import get_redis_client
+from anaesthesia_never_drugs.core.utils.http_archive import HttpArchive, get_session
+from anaesthesia_never_drugs.core.utils.local_cache import (
+    LocalCache,
+    lookup_cache,
+    negative_search_cache,
+    search_cache,
+)
+from anaesthesia_never_drugs.core.utils.normalise import normalise_query
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture(autouse=True)
+def clear_search_caches(monkeypatch):
+    # The generation and cached results would otherwise carry over between tests
+    cache.clear()
+    for local_cache in [search_cache, lookup_cache, negative_search_cache]:
+        local_cache.clear()
+    # Tasks are not run eagerly, so queued tasks would be published to the broker
+    monkeypatch.setattr(build_search_bloom_filter, 'delay', lambda *args: None)
+    monkeypatch.setattr(refresh_search_results, 'delay', lambda *args: None)
+
+
+@pytest.fixture
+def search_index():
+    content_type = ContentType.objects.get_for_model(SearchIndex)
+    names = ['Propofol', 'Propofol lipuro', 'Suxamethonium', 'Sevoflurane', 'Malignant hyperthermia']
+    SearchIndex.objects.bulk_create(
+        SearchIndex(name=name, content='', content_type=content_type, object_id=pk, searchable=True)
+        for pk, name in enumerate(names, start=1)
+    )
+
+
+def test_search_vector_maintained_by_trigger(search_index):
+    sevoflurane = SearchQuery('sevoflurane', config='english')
+    desflurane = SearchQuery('desflurane', config='english')
+    search_index_entry = SearchIndex.objects.get(name='Sevoflurane')
+    assert search_index_entry.search_vector_processed
+    assert SearchIndex.objects.filter(pk=search_index_entry.pk, search_vector=sevoflurane).exists()
+
+    search_index_entry.name = 'Desflurane'
+    search_index_entry.search_vector_processed = False
+    search_index_entry.save()
+    search_index_entry.refresh_from_db()
+
+    assert search_index_entry.search_vector_processed
+    assert SearchIndex.objects.filter(pk=search_index_entry.pk, search_vector=desflurane).exists()
+    assert not SearchIndex.objects.filter(pk=search_index_entry.pk, search_vector=sevoflurane).exists()
+
+
+def test_search_candidates_use_indexes(search_index):
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')  # Small tables are otherwise scanned
+
+    plan = SearchIndex.rank_candidates('propofol').explain()
+
+    assert 'Seq Scan' not in plan
+    assert 'name_gin_trgm_idx' in plan or 'idx_similarity_name' in plan
+    assert 'search_vector' in plan and 'Bitmap Index Scan' in plan
+
+
+def test_search_ranks_candidates(search_index):
+    results = list(SearchIndex.rank_candidates('propofol').values_list('name', flat=True))
+
+    assert results[0] == 'Propofol'
+
+
+def test_search_pages_follow_tokens(search_index, settings):
+    settings.SEARCH_CACHE_TIMEOUT = 60
+    first_page = SearchIndex.search_page('propofol', page_size=1)
+    second_page = SearchIndex.search_page('propofol', page_size=1, page_token=first_page.next_page_token)
+
+    assert first_page.estimated_total == 2
+    assert [result.name for result in first_page.results] == ['Propofol']
+    assert [result.name for result in second_page.results] == ['Propofol lipuro']
+    assert second_page.next_page_token is None
+
+
+def test_search_results_rehydrated_in_ranked_order(search_index, settings):
+    settings.SEARCH_CACHE_TIMEOUT = 60
+    cold = SearchIndex.search_page('propofol')  # Rows from the ranking query
+    warm = SearchIndex.search_page('propofol')  # Rehydrated from the cached ids
+    assert [result.name for result in cold.results] == [result.name for result in warm.results]
+
+    result_ids = list(SearchIndex.objects.order_by('-name').values_list('id', flat=True))
+    assert [result.pk for result in SearchIndex.get_results_by_ids(result_ids)] == result_ids
+
+
+def test_query_log_buffers_and_flushes():
+    redis_client = get_redis_client()
+    heavy_hitters = SearchQueryLog.get_heavy_hitters()
+    redis_client.delete(
+        SearchQueryLog.BUFFER_KEY, f'{SearchQueryLog.BUFFER_KEY}_processing',
+        heavy_hitters.sketch_key, heavy_hitters.top_key,
+    )
+
+    for query in ['propofol', 'sevoflurane', 'propofol']:
+        SearchQueryLog.log_query(query)
+    assert not SearchQueryLog.objects.exists()  # No database writes on the request path
+
+    assert SearchQueryLog.flush_buffer() == 2
+    assert SearchQueryLog.flush_buffer() == 0
+    assert SearchQueryLog.get_top_queries() == ['propofol', 'sevoflurane']
+
+    assert SearchQueryLog.persist_top_queries() == 2
+    assert list(SearchQueryLog.objects.values_list('query', 'count')) == [('propofol', 2), ('sevoflurane', 1)]
+
+
+def test_heavy_hitters_keep_top_k():
+    redis_client = get_redis_client()
+    heavy_hitters = HeavyHitters(redis_client, 'test_heavy_hitters', k=2, width=64, depth=4)
+    redis_client.delete(heavy_hitters.sketch_key, heavy_hitters.top_key)
+
+    heavy_hitters.add_counts({f'query {i}': 1 for i in range(200)})
+    heavy_hitters.add_counts({'propofol': 50, 'sevoflurane': 30})
+
+    assert [query for query, _ in heavy_hitters.top()] == ['propofol', 'sevoflurane']
+    assert heavy_hitters.estimate('propofol') >= 50  # Never undercounts
+    assert redis_client.hlen(heavy_hitters.sketch_key) <= 4 * 64  # Fixed memory
+
+
+def test_single_flight_waits_for_the_ranking_process(monkeypatch):
+    generation = SearchIndex.get_generation()
+    cache_key, lock_key = SearchIndex.get_cache_keys('propofol', generation)
+    ranked = {'ids': [1], 'total': 1, 'fresh_until': time.time() + 60}
+    monkeypatch.setattr(SearchIndex, 'rank', lambda query: pytest.fail('Ranked by a waiting process'))
+
+    # Another process holds the lock and caches its result shortly after
+    cache.add(lock_key, True)
+    threading.Timer(0.1, cache.set, [cache_key, ranked]).start()
+
+    assert SearchIndex.get_shared_ranked_results('propofol', generation) == (None, ranked)
+
+
+def test_stale_results_served_while_refreshing(monkeypatch):
+    generation = SearchIndex.get_generation()
+    cache_key, _ = SearchIndex.get_cache_keys('propofol', generation)
+    stale = {'ids': [1], 'total': 1, 'fresh_until': time.time() - 1}
+    cache.set(cache_key, stale)
+
+    refreshes = []
+    monkeypatch.setattr(refresh_search_results, 'delay', lambda *args: refreshes.append(args))
+
+    assert SearchIndex.get_shared_ranked_results('propofol', generation) == (None, stale)
+    assert SearchIndex.get_shared_ranked_results('propofol', generation) == (None, stale)
+    assert refreshes == [('propofol', generation)]  # One refresh while the lock is held
+
+
+def test_local_cache_evicts_least_recently_used(monkeypatch):
+    local_cache = LocalCache(maxsize=2, timeout=60)
+    local_cache.set('propofol', 1)
+    local_cache.set('sevoflurane', 2)
+    local_cache.get('propofol')
+    local_cache.set('suxamethonium', 3)
+
+    assert local_cache.get('sevoflurane') is None
+    assert local_cache.get('propofol') == 1
+    assert len(local_cache) == 2
+
+    local_cache.set('ketamine', 4, timeout=None)
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 61)
+    assert local_cache.get('suxamethonium') is None
+    assert local_cache.get('ketamine') == 4
+
+
+def test_repeated_search_served_from_local_cache(search_index, settings, monkeypatch):
+    settings.SEARCH_CACHE_TIMEOUT = 60
+    SearchIndex.search_page('propofol')
+    monkeypatch.setattr(SearchIndex, 'get_shared_ranked_results', lambda *args: pytest.fail('Shared cache used'))
+
+    page = SearchIndex.search_page('propofol')
+    assert [result.name for result in page.results] == ['Propofol', 'Propofol lipuro']
+
+
+def test_new_generation_bypasses_cached_results(search_index, settings):
+    settings.SEARCH_CACHE_TIMEOUT = 60
+    assert SearchIndex.search_page('propofol').estimated_total == 2
+
+    content_type = ContentType.objects.get_for_model(SearchIndex)
+    SearchIndex.objects.create(name='Propofol', content='', content_type=content_type, object_id=6, searchable=True)
+    assert SearchIndex.search_page('propofol').estimated_total == 2  # Cached for this generation
+
+    SearchIndex.bump_generation()
+    assert SearchIndex.search_page('propofol').estimated_total == 3
+
+
+def test_search_returns_ranked_rows_without_requerying(search_index):
+    with CaptureQueriesContext(connection) as queries:
+        names = [result.name for result in SearchIndex.search('propofol')]
+    assert names == ['Propofol', 'Propofol lipuro']
+    assert len([query for query in queries.captured_queries if 'core_searchindex' in query['sql']]) == 1
+
+    assert [result.name for result in SearchIndex.search('propofol')] == names  # Served from the cache
+
+
+def test_prefix_results_reused_for_longer_queries(search_index, settings, monkeypatch):
+    settings.SEARCH_CACHE_TIMEOUT = 60
+    SearchIndex.search_page('propof')
+    monkeypatch.setattr(SearchIndex, 'get_shared_ranked_results', lambda *args: pytest.fail('Ranked again'))
+
+    page = SearchIndex.search_page('propofol')
+    assert [result.name for result in page.results] == ['Propofol', 'Propofol lipuro']
+
+
+@pytest.mark.parametrize('page_size, expected', [('0', 1), ('-3', 1), ('abc', 20), ('1000', 50), ('5', 5)])
+def test_page_size_is_clamped(rf, page_size, expected):
+    assert views.get_page_size(rf.get('/search', {'page_size': page_size})) == expected
+
+
+def test_search_page_with_negative_page_size(search_index):
+    page = SearchIndex.search_page('propofol', page_size=-1)
+
+    assert [result.name for result in page.results] == ['Propofol']
+    assert page.next_page_token is not None
+
+
+def test_prefix_reuse_filters_in_process(search_index):
+    content_type = ContentType.objects.get_for_model(SearchIndex)
+    SearchIndex.objects.create(
+        name='Diprivan', content='Propofol emulsion', content_type=content_type, object_id=6, searchable=True,
+    )
+
+    SearchIndex.search_page('propof')
+    with CaptureQueriesContext(connection) as queries:
+        reused = SearchIndex.search_page('propofol')
+        reused_names = [result.name for result in reused.results]
+    assert reused.approximate
+    assert len(queries) == 1  # Only the rows of the page are fetched
+
+    cache.clear()
+    search_cache.clear()
+    cold = SearchIndex.search_page('propofol')
+    assert not cold.approximate
+
+    # Diprivan is matched on content by 'propofol' but not by 'propof', so only a cold search finds it
+    cold_names = [result.name for result in cold.results]
+    assert 'Diprivan' in cold_names
+    assert reused_names == [name for name in cold_names if name != 'Diprivan']
+
+
+def test_prefix_index_lookup():
+    entries = [
+        AutocompleteEntry(1, 'Propofol'),
+        AutocompleteEntry(2, 'Malignant hyperthermia'),
+        AutocompleteEntry(3, 'Promethazine'),
+    ]
+    index = PrefixIndex(entries)
+
+    assert [entry.id for entry in index.lookup('pro')] == [1, 3]
+    assert [entry.id for entry in index.lookup('hy')] == [2]
+    assert index.lookup('x') == []
+
+
+def test_autocomplete_rebuilds_in_background(monkeypatch):
+    autocomplete = Autocomplete()
+    previous = autocomplete.index = PrefixIndex([AutocompleteEntry(1, 'Propofol')])
+    autocomplete.generation = SearchIndex.get_generation()
+    SearchIndex.bump_generation()
+
+    built = threading.Event()
+    monkeypatch.setattr(autocomplete, 'build', built.set)
+
+    # The previous index keeps serving while the new one is built
+    assert autocomplete.get_index() is previous
+    assert built.wait(timeout=5)
+
+
+def test_short_query_rendered_from_autocomplete_index(client, search_index, monkeypatch):
+    monkeypatch.setattr(views, 'autocomplete', Autocomplete())
+    views.autocomplete.get_index()  # Built once per process
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get('/search', {'q': 'pro'}, HTTP_HX_REQUEST='true')
+
+    assert b'Propofol lipuro' in response.content
+    assert not [query for query in queries if 'core_searchindex' in query['sql']]
+
+
+def test_autocomplete_responses_versioned_by_index_generation(client, search_index, monkeypatch):
+    monkeypatch.setattr(views, 'autocomplete', Autocomplete())
+    built_generation = views.autocomplete.get_generation()
+    SearchIndex.bump_generation()  # The autocomplete index is rebuilt later, in the background
+
+    response = client.get('/search', {'q': 'pro'}, HTTP_HX_REQUEST='true')
+    assert response.headers['ETag'].startswith(f'"{built_generation}-')
+
+
+def test_search_responds_with_etag_and_not_modified(client, search_index):
+    response = client.get('/search', {'q': 'propofol'}, HTTP_HX_REQUEST='true')
+    etag = response.headers['ETag']
+
+    assert response.status_code == 200
+    assert str(SearchIndex.get_generation()) in etag
+    assert client.get('/search', {'q': 'propofol'}, HTTP_HX_REQUEST='true', HTTP_IF_NONE_MATCH=etag).status_code == 304
+    other_response = client.get('/search', {'q': 'sevoflurane'}, HTTP_HX_REQUEST='true', HTTP_IF_NONE_MATCH=etag)
+    assert other_response.status_code == 200
+
+    # Changed index rows change the ETag
+    SearchIndex.bump_generation()
+    assert client.get('/search', {'q': 'propofol'}, HTTP_HX_REQUEST='true', HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+def test_search_fragment_invalidated_by_index_change(client, search_index, django_capture_on_commit_callbacks):
+    response = client.get('/search', {'q': 'propofol'}, HTTP_HX_REQUEST='true')
+    assert 'Propofol lipuro' in response.content.decode()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        SearchIndex.objects.filter(name='Propofol lipuro').delete()
+
+    response = client.get('/search', {'q': 'propofol'}, HTTP_HX_REQUEST='true')
+    assert 'Propofol lipuro' not in response.content.decode()
+
+
+def test_empty_search_fragment_cached_briefly(client, search_index, monkeypatch, settings):
+    timeouts = []
+    set_fragment = views.cache.set
+
+    def record_fragment(key, value, timeout=None, **kwargs):
+        if key.startswith('search_fragment_'):
+            timeouts.append(timeout)
+        return set_fragment(key, value, timeout=timeout, **kwargs)
+
+    monkeypatch.setattr(views.cache, 'set', record_fragment)
+
+    client.get('/search', {'q': 'xylometazoline'}, HTTP_HX_REQUEST='true')
+    client.get('/search', {'q': 'propofol'}, HTTP_HX_REQUEST='true')
+
+    assert timeouts == [negative_search_cache.timeout, settings.SEARCH_CACHE_TIMEOUT]
+
+
+def test_common_queries_cached_once_per_generation(monkeypatch):
+    searched = []
+    monkeypatch.setattr(SearchQueryLog, 'get_top_queries', lambda n: ['propofol', 'sevoflurane'][:n])
+    monkeypatch.setattr(SearchIndex, 'search', lambda query, return_result=True: searched.append(query))
+
+    cache_common_queries()
+    cache_common_queries()
+    assert searched == ['propofol', 'sevoflurane']
+
+    SearchIndex.bump_generation()
+    cache_common_queries()
+    assert searched == ['propofol', 'sevoflurane'] * 2
+
+
+def test_normalise_query():
+    assert normalise_query('  Propofol  ') == 'propofol'
+    assert normalise_query('PROPOFOL!') == 'propofol'
+    assert normalise_query('Sévoflurane') == 'sevoflurane'
+    assert normalise_query('ｐｒｏｐｏｆｏｌ') == 'propofol'
+    assert normalise_query('beta-blocker\t x') == 'beta blocker x'
+    assert len(normalise_query('a' * 1000)) == 100
+
+
+def test_normalisation_raises_hit_rate():
+    raw_queries = ['Propofol ', 'propofol', 'propofol  ', 'PROPOFOL!', 'Sévoflurane', 'sevoflurane']
+    queries = [(query, 1) for query in raw_queries]
+
+    lower_rate, _ = get_hit_rate(queries, lambda query: query.lower())
+    normalised_rate, normalised_keys = get_hit_rate(queries, normalise_query)
+
+    assert normalised_keys == 2
+    assert normalised_rate > lower_rate
+
+
+def test_bloom_filter_has_no_false_negatives():
+    items = [f'item {i}' for i in range(1000)]
+    bloom_filter = BloomFilter.for_capacity(len(items), error_rate=0.01)
+    for item in items:
+        bloom_filter.add(item)
+
+    assert all(item in bloom_filter for item in items)
+    assert sum(f'other {i}' in bloom_filter for i in range(1000)) < 50
+
+
+def test_bloom_filter_rules_out_impossible_queries(search_index):
+    SearchIndex.objects.filter(name='Suxamethonium').update(content='Causes a dry mouth')
+    bloom_filter = SearchIndex.build_bloom_filter()
+
+    assert not SearchIndex.is_impossible_query('propofol', bloom_filter)
+    assert not SearchIndex.is_impossible_query('propofl', bloom_filter)
+    assert not SearchIndex.is_impossible_query('hyperthermia', bloom_filter)
+    assert not SearchIndex.is_impossible_query('dry', bloom_filter)  # Matched on its stem, dri
+    assert SearchIndex.is_impossible_query('xqzjvw', bloom_filter)
+    assert SearchIndex.is_impossible_query('the', bloom_filter)  # Only stop words
+
+
+def test_bloom_filter_updated_with_changed_rows(search_index, monkeypatch):
+    generation = SearchIndex.get_generation()
+    SearchIndex.update_bloom_filter(generation)
+
+    content_type = ContentType.objects.get_for_model(SearchIndex)
+    SearchIndex.objects.create(name='Dantrolene', content='', content_type=content_type, object_id=6, searchable=True)
+    monkeypatch.setattr(SearchIndex, 'build_bloom_filter', lambda: pytest.fail('Built from the whole table'))
+    bloom_filter = SearchIndex.update_bloom_filter(generation + 1)
+
+    assert not SearchIndex.is_impossible_query('dantrolene', bloom_filter)
+    assert cache.get(SearchIndex.BLOOM_FILTER_CACHE_KEY)['generation'] == generation + 1
+
+
+def test_recompute_search_vectors_in_windows(search_index):
+    SearchIndex.objects.update(search_vector=None, search_vector_processed=False)
+    progress = []
+
+    updated = SearchIndex.recompute_search_vectors(batch_size=2, progress=lambda *args: progress.append(args))
+
+    assert updated == 5
+    assert progress == [(2, 5), (4, 5), (5, 5)]
+    assert not SearchIndex.objects.filter(search_vector_processed=False).exists()
+    assert SearchIndex.objects.filter(search_vector=SearchQuery('propofol', config='english')).count() == 2
+
+
+def test_rebuild_index_rows_upserts_and_removes():
+    content_type = ContentType.objects.get_for_model(Drug)
+    drug = Drug.objects.create(name='Ketamine')
+    SearchIndex.objects.create(name='Removed', content_type=content_type, object_id=drug.pk + 1)
+
+    assert SearchIndex.rebuild_index_rows(content_type, [drug.pk, drug.pk + 1]) == 2  # One written, one deleted
+    assert SearchIndex.rebuild_index_rows(content_type, [drug.pk]) == 0  # Unchanged content hash
+    Drug.objects.filter(pk=drug.pk).update(name='Esketamine')  # Bypasses signals
+    assert SearchIndex.rebuild_index_rows(content_type, [drug.pk]) == 1
+
+    rows = SearchIndex.objects.filter(content_type=content_type)
+    assert [(row.object_id, row.name, row.model_name) for row in rows] == [(drug.pk, 'Esketamine', 'core.drug')]
+
+
+def test_drain_publishes_a_new_generation(django_capture_on_commit_callbacks):
+    get_redis_client().delete(SearchIndex.DIRTY_SET_KEY)
+    with django_capture_on_commit_callbacks(execute=True):
+        Drug.objects.create(name='Ketamine')
+    generation = SearchIndex.bump_generation()
+
+    assert SearchIndex.drain_dirty_set() == {'drained': 1, 'changed': 1}
+    assert SearchIndex.get_generation() == generation + 1
+
+    # Nothing changed, so cached searches are kept
+    assert SearchIndex.drain_dirty_set() == {'drained': 0, 'changed': 0}
+    assert SearchIndex.get_generation() == generation + 1
+
+
+def test_failed_drain_is_retried(monkeypatch, django_capture_on_commit_callbacks):
+    redis_client = get_redis_client()
+    redis_client.delete(SearchIndex.DIRTY_SET_KEY, SearchIndex.PROCESSING_SET_KEY)
+    with django_capture_on_commit_callbacks(execute=True):
+        drug = Drug.objects.create(name='Ketamine')
+
+    def fail(content_type, ids):
+        raise RuntimeError
+
+    with monkeypatch.context() as patch:
+        patch.setattr(SearchIndex, 'rebuild_index_rows', fail)
+        with pytest.raises(RuntimeError):
+            SearchIndex.drain_dirty_set()
+
+    # The member is kept until its rebuild commits
+    member = f'{ContentType.objects.get_for_model(Drug).id}:{drug.pk}'.encode()
+    assert redis_client.smembers(SearchIndex.PROCESSING_SET_KEY) == {member}
+
+    assert SearchIndex.drain_dirty_set() == {'drained': 1, 'changed': 1}
+    assert not redis_client.exists(SearchIndex.DIRTY_SET_KEY, SearchIndex.PROCESSING_SET_KEY)
+
+
+def test_bulk_delete_bumps_generation_once(django_capture_on_commit_callbacks):
+    Drug.objects.bulk_create([Drug(name=f'Drug {i}') for i in range(3)])
+    content_type = ContentType.objects.get_for_model(Drug)
+    SearchIndex.rebuild_index_rows(content_type, Drug.objects.values_list('pk', flat=True))
+    generation = SearchIndex.bump_generation()
+
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        Drug.objects.all().delete()
+
+    assert len(callbacks) == 1
+    assert SearchIndex.get_generation() == generation + 1
+    assert not SearchIndex.objects.filter(content_type=content_type).exists()
+
+
+def test_deferred_indexing_flushes_once():
+    class Sender:
+        pass
+
+    flushed = []
+    register_flush(Sender, flushed.append)
+
+    assert not defer_instance(Sender, 1)
+    with deferred_indexing():
+        with deferred_indexing():
+            assert defer_instance(Sender, 1)
+        assert defer_instance(Sender, 1)
+        assert defer_instance(Sender, 2)
+        assert flushed == []
+
+    assert flushed == [{1, 2}]
+
+    with pytest.raises(ValueError):
+        with deferred_indexing():
+            defer_instance(Sender, 3)
+            raise ValueError
+    assert flushed == [{1, 2}]
+
+
+def test_create_or_update_drugs_in_bulk():
+    atc_import = AtcImport.objects.create(active=False)
+    propofol = Drug.objects.create(name='propofol')
+    chemical_substances = [
+        ChemicalSubstance.objects.create(name=name, code=code, atc_import=atc_import)
+        for name, code in [('Propofol', 'N01AX10'), ('Ketamine', 'N01AX03'), ('ketamine', 'N01AX14')]
+    ]
+
+    with CaptureQueriesContext(connection) as queries:
+        ChemicalSubstance.create_or_update_drugs(chemical_substances)
+    ChemicalSubstance.create_or_update_drugs(chemical_substances)
+
+    assert len(queries) <= 4
+    assert Drug.objects.count() == 2
+    assert set(propofol.atc_category.values_list('code', flat=True)) == {'N01AX10'}
+    ketamine = Drug.objects.get(name='Ketamine')
+    assert set(ketamine.atc_category.values_list('code', flat=True)) == {'N01AX03', 'N01AX14'}
+
+
+def test_create_or_update_conditions_in_bulk():
+    orpha_import = OrphaImport.objects.create(active=False)
+    date_updated = timezone.now()
+    Condition.objects.create(
+        name='Old name', orpha_code='ORPHA:1', date_updated=date_updated, status='Inactive', searchable=False,
+    )
+    orpha_entries = [
+        OrphaEntry.objects.create(
+            name=name, orpha_code=orpha_code, orpha_import=orpha_import, date_updated=date_updated, status='Active',
+        )
+        for name, orpha_code in [('Malignant hyperthermia', 'ORPHA:1'), ('Porphyria', 'ORPHA:2')]
+    ]
+
+    with CaptureQueriesContext(connection) as queries:
+        OrphaEntry.create_or_update_conditions(orpha_entries)
+
+    assert len(queries) <= 3
+    conditions = Condition.objects.order_by('orpha_code')
+    assert [(c.name, c.status, c.searchable) for c in conditions] == [
+        ('Malignant hyperthermia', 'Active', False),
+        ('Porphyria', 'Active', True),
+    ]
+
+
+@pytest.mark.django_db(transaction=True)  # Tables with pending foreign key checks cannot be dropped
+def test_rebuild_swaps_in_new_table():
+    content_type = ContentType.objects.get_for_model(Drug)
+    propofol = Drug.objects.create(name='Propofol')
+    ketamine = Drug.objects.create(name='Ketamine')
+    thiopental = Drug.objects.create(name='Thiopental')
+    SearchIndex.rebuild_index_rows(content_type, [propofol.pk])
+    propofol_index_id = SearchIndex.objects.get(object_id=propofol.pk).id
+
+    SearchIndex.create_rebuild_table()
+    for rebuild_range in SearchIndex.get_rebuild_ranges():
+        SearchIndex.load_rebuild_rows(*rebuild_range)
+        assert SearchIndex.load_rebuild_rows(*rebuild_range) == 0  # A retried range inserts nothing
+    thiopental.delete()
+    count = SearchIndex.swap_rebuild_table(timezone.now().isoformat())
+
+    assert count == 2
+    assert not SearchIndex.objects.filter(object_id=thiopental.pk).exists()
+    assert SearchIndex.objects.get(object_id=propofol.pk).id == propofol_index_id  # Ids are kept
+    assert SearchIndex.objects.filter(object_id=ketamine.pk, search_vector_processed=True).exists()
+    assert SearchIndex.rank_candidates('propofol').first().object_id == propofol.pk
+
+
+def test_reconcile_removes_orphans_and_adds_missing_rows():
+    content_type = ContentType.objects.get_for_model(Drug)
+    propofol = Drug.objects.create(name='Propofol')
+    SearchIndex.objects.create(name='Removed', content_type=content_type, object_id=propofol.pk + 100)
+
+    counts = SearchIndex.reconcile()
+
+    assert counts == {'deleted': 1, 'inserted': 1}
+    assert list(SearchIndex.objects.values_list('object_id', 'name')) == [(propofol.pk, 'Propofol')]
+    assert SearchIndex.reconcile() == {'deleted': 0, 'inserted': 0}
+
+
+def test_parse_atc_level():
+    # Links to the page's ancestors are navigation, not children
+    navigation = (
+        '<a href="./">ATC/DDD Index</a><a href="./">New search</a>'
+        '<a href="?code=N">NERVOUS SYSTEM</a><a href="?code=N01">ANESTHETICS</a>'
+    )
+    children = (
+        '<a href="?code=N01A&showdescription=no">ANESTHETICS, GENERAL</a>'
+        '<a href="?code=N01B&showdescription=no">ANESTHETICS, LOCAL</a>'
+    )
+    content = f'<html><body><div id="content">{navigation}{children}</div></body></html>'
+
+    assert parse_atc_level(content, 'N01') == [
+        {'code': 'N01A', 'level': 3, 'parent': 'N01', 'name': 'ANESTHETICS, GENERAL'},
+        {'code': 'N01B', 'level': 3, 'parent': 'N01', 'name': 'ANESTHETICS, LOCAL'},
+    ]
+
+
+def test_parse_atc_roots():
+    links = (
+        '<a href="./">ATC/DDD Index</a>'
+        '<a href="?code=A&showdescription=no">ALIMENTARY TRACT AND METABOLISM</a>'
+        '<a href="?code=N&showdescription=no">NERVOUS SYSTEM</a>'
+        '<a href="?code=N01&showdescription=no">ANESTHETICS</a>'
+    )
+    content = f'<html><body><a href="?code=B">Outside the content</a><div id="content">{links}</div></body></html>'
+
+    assert parse_atc_roots(content) == {'A': 'ALIMENTARY TRACT AND METABOLISM', 'N': 'NERVOUS SYSTEM'}
+
+
+def test_rate_limiter_spaces_requests():
+    async def get_start_times():
+        rate_limiter = RateLimiter(20)
+
+        async def start():
+            await rate_limiter.wait()
+            return time.monotonic()
+
+        return sorted(await asyncio.gather(*(start() for _ in range(4))))
+
+    # Measured from the first start, as a sleep may end slightly early or late
+    start_times = asyncio.run(get_start_times())
+    assert all(start - start_times[0] >= i * 0.045 for i, start in enumerate(start_times))
+
+
+async def no_sleep(delay):
+    pass
+
+
+def fetch_page(crawler, handler):
+    async def fetch():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await crawler.fetch(client, get_atc_url('N01'), asyncio.Semaphore(1), RateLimiter(1000))
+
+    return asyncio.run(fetch())
+
+
+def test_crawler_retries_failed_requests(monkeypatch):
+    monkeypatch.setattr(asyncio, 'sleep', no_sleep)
+
+    received = []
+
+    def respond(*statuses):
+        statuses = iter(statuses)
+        return lambda request: received.append(request) or httpx.Response(next(statuses))
+
+    response = fetch_page(AtcCrawler(max_retries=3), respond(503, 429, 200))
+    assert response.status_code == 200
+    assert len(received) == 3
+
+    # Retries are bounded
+    received.clear()
+    with pytest.raises(httpx.HTTPStatusError):
+        fetch_page(AtcCrawler(max_retries=1), respond(500, 500))
+    assert len(received) == 2
+
+    # Client errors are not retried
+    received.clear()
+    with pytest.raises(httpx.HTTPStatusError):
+        fetch_page(AtcCrawler(max_retries=3), respond(404))
+    assert len(received) == 1
+
+
+def test_crawl_stops_when_the_caller_stops(monkeypatch):
+    requests = []
+
+    def handler(request):
+        # Every page below a level 4 code lists nine children
+        requests.append(request)
+        atc_code = request.url.params['code']
+        width = {1: 2, 3: 1, 4: 1, 5: 2}[len(atc_code)]
+        links = ''.join(
+            f'<a href="?code={atc_code}{i:0{width}}&showdescription=no">Entry {i}</a>' for i in range(1, 10)
+        )
+        return httpx.Response(200, content=f'<html><body><div id="content">{links}</div></body></html>')
+
+    transport = httpx.MockTransport(handler)
+    monkeypatch.setattr(AtcCrawler, 'get_client', lambda crawler: httpx.AsyncClient(transport=transport))
+    entries = scrape_atc_concurrently(['N'], max_queued=2, requests_per_second=None, parse_workers=1)
+    assert len([next(entries) for _ in range(3)]) == 3
+    entries.close()
+
+    time.sleep(0.5)
+    request_count = len(requests)
+    time.sleep(0.5)
+    assert len(requests) == request_count  # No requests once the crawl has stopped
+    assert request_count < 50
+
+
+def test_crawler_revalidates_cached_pages(tmp_path):
+    content = b'<html><body><div id="content"></div></body></html>'
+    validators = []
+
+    def handler(request):
+        validators.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"n01"':
+            return httpx.Response(304)
+        return httpx.Response(200, headers={'ETag': '"n01"'}, content=content)
+
+    crawler = AtcCrawler(cache_dir=str(tmp_path), max_age=3600)
+
+    async def load_pages():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            args = (asyncio.Semaphore(1), RateLimiter(1000))
+            return [
+                await crawler.load_page(client, 'N01', False, *args),
+                await crawler.load_page(client, 'N01', False, *args),  # Revalidated, as its parent changed
+                await crawler.load_page(client, 'N01', True, *args),  # Fresh, below an unchanged parent
+            ]
+
+    assert asyncio.run(load_pages()) == [(content, True), (content, False), (content, False)]
+    assert validators == [None, '"n01"']
+    assert crawler.stats['not_modified'] == 1
+    assert crawler.stats['from_cache'] == 1
+
+
+def test_http_archive_replay(settings, tmp_path):
+    settings.HTTP_ARCHIVE_MODE = 'replay'
+    settings.HTTP_ARCHIVE_PATH = str(tmp_path)
+    url = 'https://api.orphacode.org/EN/ClinicalEntity'
+    headers = [('Content-Type', 'application/json'), ('Content-Encoding', 'gzip')]
+    HttpArchive(str(tmp_path)).store('GET', url, 200, headers, b'[{"ORPHAcode": 1}]')
+
+    session = get_session()
+    response = session.get(url)
+
+    assert response.status_code == 200
+    assert response.json() == [{'ORPHAcode': 1}]
+    assert 'Content-Encoding' not in response.headers  # Bodies are archived decoded
+    with pytest.raises(ArchiveMissException):
+        session.get('https://api.fda.gov/download.json')
+
+
+def test_http_archive_streams_bodies(settings, tmp_path):
+    settings.HTTP_ARCHIVE_MODE = 'replay'
+    settings.HTTP_ARCHIVE_PATH = str(tmp_path)
+    archive = HttpArchive(str(tmp_path))
+    url = 'https://download.open.fda.gov/drug/drugsfda/drug-drugsfda-0001-of-0001.json.zip'
+
+    # Only bodies read to the end are archived
+    partial = archive.writer('GET', url, 200, [])
+    partial.write(b'PK')
+    partial.discard()
+    with pytest.raises(ArchiveMissException):
+        archive.load('GET', url)
+
+    writer = archive.writer('GET', url, 200, [('Content-Type', 'application/zip')])
+    for _ in range(4):
+        writer.write(b'PK' * 50000)
+    writer.commit()
+    assert not list(tmp_path.glob('*.tmp'))
+
+    with get_session().get(url, stream=True) as response:
+        assert b''.join(response.iter_content(chunk_size=8192)) == b'PK' * 200000
+
+
+def test_drug_index_content_matches_bulk_queryset():
+    atc_import = AtcImport.objects.create(active=False)
+    WhoAtc.bulk_upsert([
+        {'code': 'N01AX', 'level': 4, 'parent': 'N01A', 'name': 'Other general anesthetics'},
+        {'code': 'N01AX10', 'level': 5, 'parent': 'N01AX', 'name': 'Propofol'},
+        {'code': 'N05CM99', 'level': 5, 'parent': 'N05CM', 'name': 'Propofol'},  # Parent not imported yet
+    ], atc_import, root_name='NERVOUS SYSTEM')
+    orphan = ChemicalSubstance.objects.create(name='Propofol', code='N01AX99', atc_import=atc_import)
+
+    drug = Drug.objects.create(name='Propofol')
+    for code in ['N05CM99', 'N01AX10']:
+        DrugCategory.objects.create(drug=drug, category=ChemicalSubstance.objects.get(code=code))
+    DrugCategory.objects.create(drug=drug, category=orphan)
+
+    expected = 'ATC code N05CM, Other general anesthetics - ATC code N01AX'
+    assert drug.get_search_index_data()['content'] == expected
+    assert Drug.get_search_index_queryset().get(index_object_id=drug.pk)['index_content'] == expected
+
+
+def test_bulk_upsert_atc_entries():
+    atc_import = AtcImport.objects.create(active=False)
+    entries = [
+        {'code': 'N01A', 'level': 3, 'parent': 'N01', 'name': 'ANESTHETICS, GENERAL'},
+        {'code': 'N01AX', 'level': 4, 'parent': 'N01A', 'name': 'Other general anesthetics'},
+        {'code': 'N01AX10', 'level': 5, 'parent': 'N01AX', 'name': 'propofol'},
+    ]
+    assert WhoAtc.bulk_upsert(entries, atc_import, root_name='NERVOUS SYSTEM') == 3
+
+    # A later chunk names the placeholder parent and overwrites existing entries
+    entries = [
+        {'code': 'N01', 'level': 2, 'parent': 'N', 'name': 'ANESTHETICS'},
+        {'code': 'N01AX10', 'level': 5, 'parent': 'N01AX', 'name': 'Propofol'},
+    ]
+    WhoAtc.bulk_upsert(entries, atc_import, root_name='NERVOUS SYSTEM')
+
+    propofol = ChemicalSubstance.objects.get(atc_import=atc_import)
+    assert propofol.name == 'Propofol'
+    assert propofol.parent.parent.parent.name == 'ANESTHETICS'
+    assert propofol.parent.parent.parent.parent.name == 'NERVOUS SYSTEM'
@@ -1,83 +1,371 @@
-import requests
+import asyncio
+from collections import Counter
+import concurrent.futures
+import contextlib
+import hashlib
+import httpx
+import json
+import logging
+import multiprocessing
+import os
+import queue
 import re
+import threading
 import time
-from bs4 import BeautifulSoup, SoupStrainer
-from urllib.parse import urlparse, parse_qs
+from lxml import etree
+import lxml.html
 
 from . import filters
+from .http_archive import get_archive_mode, get_async_transport, get_session, REPLAY
+
+logger = logging.getLogger(__name__)
 
 # Scrape the Anatomical Therapeutic Chemical Classification
 
 atc_levels = {1: 1, 3: 2, 4: 3, 5: 4, 7: 5}  # len(atc_code):level
 
-session = requests.Session()  # Initialise a session to re-use TCP connections
-crawl_delay = 1
+atc_index_url = 'https://atcddd.fhi.no/atc_ddd_index/'
 
+session = get_session()  # Initialise a session to re-use TCP connections
 
-def scrape_atc_roots():
-    web_address = 'https://atcddd.fhi.no/atc_ddd_index/'
-    response = session.get(web_address)
 
-    only_id_content = SoupStrainer(id='content')
-    soup = BeautifulSoup(response.content, 'lxml', parse_only=only_id_content)
-    links = soup.find_all('a')[:-2]
-    
-    roots = {}
-    for link in links:
-        parsed_url = urlparse(link['href'])
-        query_params = parse_qs(parsed_url.query)
-        atc_code = query_params.get('code', [None])[0]
-        link_text = link.get_text(strip=True)
-        roots[atc_code] = link_text
-    
-    return roots
+def get_atc_url(atc_code):
+    return f'{atc_index_url}?code={atc_code}&showdescription=no'
+
+
+content_links = etree.XPath('//*[@id="content"]//a[@href]')
+code_pattern = re.compile(r'[?&]code=([A-Z0-9]+)')
+
+
+def get_atc_links(content):
+    '''Yields (code, name) for each link to an ATC code within the content div of a page'''
+    document = lxml.html.fromstring(content)
+    for link in content_links(document):
+        match = code_pattern.search(link.get('href'))
+        if match:
+            yield match.group(1), link.text_content().strip()
+
 
+def parse_atc_roots(content):
+    '''Returns a dictionary of root code:name from the ATC index page'''
+    return {atc_code: name for atc_code, name in get_atc_links(content) if len(atc_code) == 1}
 
-def scrape_atc(atc_code):
+
+def parse_atc_level(content, atc_code):
     '''
-    Given an ATC root code, recursively scrapes this root
-    Yields a dictionary per entry in each level of the hierarchy processed
+    Given the page for an ATC code, returns a dictionary for each child entry
+    Children are the links to longer codes under atc_code; navigation links to ancestors are skipped
+    Runs without shared state, so pages can be parsed in a worker pool
     '''
-    # Check the current recursion level
-    level = atc_levels.get(len(atc_code))
-    
-    if not level:
-        print(f'Error: Incorrect ATC code length {atc_code}')
-        return  # Using return here to end the generator
-    
-    if level == 5:
-        return  # Stop recursion for level 5
-    
-    web_address = f'https://atcddd.fhi.no/atc_ddd_index/?code={atc_code}&showdescription=no'
-    response = session.get(web_address)
-    
-    # Implement crawl delay
-    time.sleep(crawl_delay)
-    
-    only_id_content = SoupStrainer(id='content')
-    soup = BeautifulSoup(response.content, 'lxml', parse_only=only_id_content)
-    links = soup.find_all('a')[level+2:]
-    links = links[:-1] if level == 4 else links  # Adjust for level 4 formatting
-    
-    for link in links:
-        parsed_url = urlparse(link['href'])
-        query_params = parse_qs(parsed_url.query)
-        child_atc_code = query_params.get('code', [None])[0]
-        
-        if child_atc_code and len(child_atc_code) > len(atc_code):  # Else recursion stops
-            child_level = atc_levels.get(len(child_atc_code))
-            link_text = link.get_text(strip=True)  # Ensure names are properly stripped
-            child_dict = {
+    children = []
+    seen = set()
+    for child_atc_code, name in get_atc_links(content):
+        child_level = atc_levels.get(len(child_atc_code))
+        is_child = len(child_atc_code) > len(atc_code) and child_atc_code.startswith(atc_code)
+        if child_level and is_child and child_atc_code not in seen:
+            seen.add(child_atc_code)
+            children.append({
                 'code': child_atc_code,
                 'level': child_level,
                 'parent': atc_code,
-                'name': link_text
-            }
-            
-            yield child_dict  # Yielding each child dictionary as it's processed
-            
-            # Recursively yield from child ATC codes
-            yield from scrape_atc(child_atc_code)
+                'name': name
+            })
+
+    return children
+
+
+def scrape_atc_roots():
+    response = session.get(atc_index_url)
+    return parse_atc_roots(response.content)
+
+
+# HTTP caching
+
+class HttpCache:
+    '''
+    On-disk cache of pages with their validators, keyed by URL
+    Each entry is a JSON file holding the ETag, Last-Modified, a hash of the body and the time
+    the entry was last validated, alongside a file holding the body itself
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_paths(self, url):
+        key = hashlib.md5(url.encode()).hexdigest()
+        return os.path.join(self.directory, f'{key}.json'), os.path.join(self.directory, f'{key}.body')
+
+    @staticmethod
+    def write_file(path, content, mode='wb'):
+        # Write then rename, so an interrupted import never leaves a truncated entry
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, mode) as f:
+            f.write(content)
+        os.replace(temporary_path, path)
+
+    def get(self, url):
+        '''Returns the cached entry for url with its content, or None'''
+        metadata_path, body_path = self.get_paths(url)
+        try:
+            with open(metadata_path) as f:
+                entry = json.load(f)
+            with open(body_path, 'rb') as f:
+                entry['content'] = f.read()
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def set(self, url, response):
+        '''
+        Stores a 200 response
+        Returns True if the body differs from the cached copy
+        '''
+        previous = self.get(url)
+        metadata_path, body_path = self.get_paths(url)
+        body_hash = hashlib.md5(response.content).hexdigest()
+        entry = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'body_hash': body_hash,
+            'validated_at': time.time(),
+        }
+        self.write_file(body_path, response.content)
+        self.write_file(metadata_path, json.dumps(entry), mode='w')
+        return previous is None or previous['body_hash'] != body_hash
+
+    def touch(self, url, entry):
+        '''Records that a cached entry was revalidated'''
+        metadata_path, _ = self.get_paths(url)
+        entry = {key: value for key, value in entry.items() if key != 'content'}
+        entry['validated_at'] = time.time()
+        self.write_file(metadata_path, json.dumps(entry), mode='w')
+
+    @staticmethod
+    def is_fresh(entry, max_age):
+        return time.time() - entry['validated_at'] < max_age
+
+    @staticmethod
+    def get_conditional_headers(entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+
+# Concurrent crawling
+
+class RateLimiter:
+    '''
+    Spaces the start of requests at least 1 / requests_per_second seconds apart
+    A requests_per_second of None disables the limit
+    '''
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_start = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def get_parse_executor(workers):
+    # Celery's prefork workers are daemonic and cannot start child processes
+    if multiprocessing.current_process().daemon:
+        return concurrent.futures.ThreadPoolExecutor(workers)
+    return concurrent.futures.ProcessPoolExecutor(workers)
+
+
+class AtcCrawler:
+    '''
+    Crawls the ATC hierarchy concurrently
+    - No more than requests_per_second requests are started each second
+    - No more than max_in_flight requests are outstanding at once
+    - No more than max_queued entries wait to be consumed; pages are not visited while the queue is full
+    - Pages are parsed in a pool of parse_workers, so the crawl stays network-bound
+
+    Failed requests and 429 or 5xx responses are retried with exponential backoff
+
+    With a cache_dir, pages are revalidated with If-None-Match/If-Modified-Since
+    A page that is unchanged (a 304, or a 200 with the same body) marks its subtree as unchanged:
+    its children are then served from the cache without a request while younger than max_age
+    Roots and the children of changed pages are always revalidated
+    '''
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, requests_per_second=1, max_in_flight=4, parse_workers=2, max_retries=3, timeout=30,
+                 cache_dir=None, max_age=0, max_queued=1000):
+        self.requests_per_second = requests_per_second
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.parse_workers = parse_workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # Recording must see every page and replays should be repeatable, so both bypass the cache
+        self.archive_mode = get_archive_mode()
+        self.cache = HttpCache(cache_dir) if cache_dir and not self.archive_mode else None
+        self.max_age = max_age
+        self.stats = Counter()
+
+    def get_client(self):
+        transport = get_async_transport(limits=httpx.Limits(max_connections=self.max_in_flight))
+        return httpx.AsyncClient(timeout=self.timeout, follow_redirects=True, transport=transport)
+
+    async def fetch(self, client, url, semaphore, rate_limiter, headers=None):
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await rate_limiter.wait()
+                try:
+                    response = await client.get(url, headers=headers)
+                    self.stats['requests'] += 1
+                    if response.status_code not in self.retry_statuses:
+                        if response.status_code != 304:
+                            response.raise_for_status()
+                        return response
+                    error = httpx.HTTPStatusError(
+                        f'{response.status_code} for {url}', request=response.request, response=response,
+                    )
+                except httpx.TransportError as e:
+                    error = e
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(2 ** attempt)
+
+        raise error
+
+    async def load_page(self, client, atc_code, parent_unchanged, semaphore, rate_limiter):
+        '''Returns (content, changed) for the page of an ATC code, using the cache where possible'''
+        url = get_atc_url(atc_code)
+        if not self.cache:
+            response = await self.fetch(client, url, semaphore, rate_limiter)
+            return response.content, True
+
+        # Cache files are small, so they are read and written on the event loop
+        cached = self.cache.get(url)
+        if cached and parent_unchanged and self.cache.is_fresh(cached, self.max_age):
+            self.stats['from_cache'] += 1
+            return cached['content'], False
+
+        headers = self.cache.get_conditional_headers(cached) if cached else None
+        response = await self.fetch(client, url, semaphore, rate_limiter, headers=headers)
+        if response.status_code == 304:
+            self.stats['not_modified'] += 1
+            self.cache.touch(url, cached)
+            return cached['content'], False
+
+        changed = self.cache.set(url, response)
+        self.stats['changed' if changed else 'unchanged'] += 1
+        return response.content, changed
+
+    async def crawl(self, root_codes):
+        '''
+        Asynchronous generator of (root_code, entry) for every entry below the given roots
+        Entries are the dictionaries returned by parse_atc_level; a parent is always yielded before its children
+        '''
+        root_codes = list(root_codes)
+        if not root_codes:
+            return
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        # Recorded pages are replayed at full speed
+        rate_limiter = RateLimiter(None if self.archive_mode == REPLAY else self.requests_per_second)
+        results = asyncio.Queue(maxsize=self.max_queued)
+        tasks = set()
+        outstanding = 0
+
+        async with self.get_client() as client:
+            with get_parse_executor(self.parse_workers) as executor:
+
+                async def visit(root_code, atc_code, parent_unchanged):
+                    nonlocal outstanding
+                    try:
+                        content, changed = await self.load_page(
+                            client, atc_code, parent_unchanged, semaphore, rate_limiter,
+                        )
+                        entries = await loop.run_in_executor(executor, parse_atc_level, content, atc_code)
+                        for entry in entries:
+                            await results.put((root_code, entry))
+                            if entry['level'] < 5:  # Level 5 entries have no children
+                                schedule(root_code, entry['code'], not changed)
+                    except Exception as e:
+                        await results.put(e)
+                    finally:
+                        outstanding -= 1
+                        if outstanding == 0:
+                            await results.put(None)  # The crawl is complete
+
+                def schedule(root_code, atc_code, parent_unchanged=False):
+                    nonlocal outstanding
+                    outstanding += 1
+                    task = asyncio.create_task(visit(root_code, atc_code, parent_unchanged))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                for root_code in root_codes:
+                    schedule(root_code, root_code)
+
+                try:
+                    while (item := await results.get()) is not None:
+                        if isinstance(item, Exception):
+                            raise item
+                        yield item
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    logger.info(f'ATC crawl: {dict(self.stats)}')
+
+
+def scrape_atc_concurrently(root_codes, max_queued=1000, **crawler_options):
+    '''
+    Runs an AtcCrawler in a background thread, yielding (root_code, entry) as pages are parsed
+    Lets synchronous callers, such as Celery tasks, consume the crawl as a generator
+
+    At most max_queued entries wait for the caller, and the crawl pauses while they do
+    The crawl stops if the caller raises or stops consuming
+    '''
+    items = queue.Queue(maxsize=max_queued)
+    stop = threading.Event()
+    done = object()
+
+    async def put(item):
+        # Polls rather than blocking, so the event loop keeps running requests already in flight
+        while not stop.is_set():
+            try:
+                items.put_nowait(item)
+                return True
+            except queue.Full:
+                await asyncio.sleep(0.05)
+        return False
+
+    async def consume():
+        crawler = AtcCrawler(max_queued=max_queued, **crawler_options)
+        try:
+            # Closing the crawl cancels its outstanding requests
+            async with contextlib.aclosing(crawler.crawl(root_codes)) as crawl:
+                async for item in crawl:
+                    if not await put(item):
+                        return
+        except Exception as e:
+            await put(e)
+        else:
+            await put(done)
+
+    threading.Thread(target=asyncio.run, args=(consume(),), daemon=True).start()
+
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
 
 
 # Filter the results
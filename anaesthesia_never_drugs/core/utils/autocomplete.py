@@ -0,0 +1,141 @@
+from bisect import bisect_left
+from collections import namedtuple
+import logging
+import re
+import threading
+import time
+
+from .normalise import normalise_query
+
+logger = logging.getLogger(__name__)
+
+# Prefix lookups for the as-you-type search box
+# Short prefixes are matched and rendered from memory in each process, without a database query
+
+MAX_PREFIX_LENGTH = 3  # Longer queries use SearchIndex.search
+RESULT_LIMIT = 20
+SCAN_LIMIT = 500  # Bounds the work done for very common prefixes
+GENERATION_CHECK_INTERVAL = 5  # Seconds between checks of the SearchIndex generation
+MIN_REBUILD_INTERVAL = 30  # Seconds between rebuilds while the index is being updated
+
+word_pattern = re.compile(r'\w+')
+
+# Holds the fields the search results template renders; only the name is indexed
+AutocompleteEntry = namedtuple('AutocompleteEntry', ['id', 'name', 'content'], defaults=[''])
+
+
+class PrefixIndex:
+    '''
+    A compact sorted array of normalised keys, each pointing at an AutocompleteEntry
+    Every word in a name is a key, as is the whole name, so 'hyp' finds 'Malignant hyperthermia'
+
+    A lookup is a binary search followed by a bounded scan of adjacent keys
+    '''
+    def __init__(self, entries):
+        self.entries = list(entries)
+
+        keys = set()
+        for position, entry in enumerate(self.entries):
+            name = normalise_query(entry.name)  # Matches the normalisation of queries
+            keys.add((name, position))
+            for word in word_pattern.findall(name):
+                keys.add((word, position))
+
+        sorted_keys = sorted(keys)
+        self.keys = [key for key, _ in sorted_keys]
+        self.positions = [position for _, position in sorted_keys]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, prefix, limit=RESULT_LIMIT):
+        prefix = prefix.lower()
+        start = bisect_left(self.keys, prefix)
+        end = min(start + SCAN_LIMIT, len(self.keys))
+
+        positions = set()
+        for i in range(start, end):
+            if not self.keys[i].startswith(prefix):
+                break
+            positions.add(self.positions[i])
+
+        # Names starting with the prefix first, then shorter names
+        matches = [self.entries[position] for position in positions]
+        matches.sort(key=lambda entry: (not entry.name.lower().startswith(prefix), len(entry.name), entry.name))
+        return matches[:limit]
+
+
+class Autocomplete:
+    '''
+    Holds the PrefixIndex for this process
+    The index is rebuilt from SearchIndex when the SearchIndex generation changes
+
+    Only the first build blocks a request
+    Later rebuilds run in a background thread while the previous index keeps serving lookups
+    '''
+    def __init__(self):
+        self.index = None
+        self.generation = None
+        self.checked_at = 0
+        self.built_at = 0
+        self.rebuilding = False
+        self.lock = threading.Lock()
+
+    def build(self):
+        from ..models.search import SearchIndex
+
+        generation = SearchIndex.get_generation()
+        rows = SearchIndex.objects.values_list('id', 'name', 'content').iterator(chunk_size=2000)
+        index = PrefixIndex(AutocompleteEntry(*row) for row in rows)
+
+        self.index = index
+        self.generation = generation
+        self.built_at = time.monotonic()
+        logger.info(f'Autocomplete index built: {len(index)} entries, generation {generation}')
+
+    def rebuild(self):
+        from django.db import connection
+
+        try:
+            self.build()
+        except Exception:
+            logger.exception('Autocomplete index rebuild failed, keeping the previous index')
+        finally:
+            self.rebuilding = False
+            connection.close()  # Each thread has its own database connection
+
+    def get_index(self):
+        from ..models.search import SearchIndex
+
+        now = time.monotonic()
+        if self.index is not None and now - self.checked_at < GENERATION_CHECK_INTERVAL:
+            return self.index
+
+        with self.lock:
+            if self.index is None:
+                self.build()
+            elif now - self.checked_at >= GENERATION_CHECK_INTERVAL and not self.rebuilding:
+                stale = SearchIndex.get_generation() != self.generation
+                if stale and now - self.built_at >= MIN_REBUILD_INTERVAL:
+                    self.rebuilding = True
+                    threading.Thread(target=self.rebuild, name='autocomplete-rebuild', daemon=True).start()
+            self.checked_at = now
+
+        return self.index
+
+    def get_generation(self):
+        '''Returns the SearchIndex generation the current index was built from'''
+        self.get_index()
+        return self.generation
+
+    def lookup(self, prefix, limit=RESULT_LIMIT):
+        return self.get_index().lookup(prefix, limit=limit)
+
+
+autocomplete = Autocomplete()
+
+
+def is_autocomplete_query(query):
+    '''Returns True if the query should be answered by the autocomplete index'''
+    query = (query or '').strip()
+    return 0 < len(query) <= MAX_PREFIX_LENGTH
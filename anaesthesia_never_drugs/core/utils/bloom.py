@@ -0,0 +1,52 @@
+import hashlib
+import math
+
+# Compact set membership for strings
+# Used to rule out search queries that cannot match anything in the index
+
+
+class BloomFilter:
+    '''
+    Bit array with hash_count positions set per item
+    Membership tests never give false negatives; false positives occur at about the error rate
+    the filter was sized for, until more than capacity items have been added
+    '''
+    def __init__(self, size, hash_count, capacity=None):
+        self.size = size
+        self.hash_count = hash_count
+        self.capacity = capacity
+        self.count = 0  # Items added that were not already present
+        self.bits = bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        '''Returns an empty filter sized to hold capacity items at the given false positive rate'''
+        capacity = max(capacity, 1)
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hash_count = max(round(size / capacity * math.log(2)), 1)
+        return cls(size, hash_count, capacity)
+
+    def get_positions(self, item):
+        '''Derives every bit position from one digest by double hashing'''
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        positions = self.get_positions(item)
+        if self.has_positions(positions):
+            return
+        for position in positions:
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def has_positions(self, positions):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def is_full(self):
+        '''Returns True once the false positive rate has grown past the error rate the filter was sized for'''
+        return self.capacity is not None and self.count > self.capacity
+
+    def __contains__(self, item):
+        return self.has_positions(self.get_positions(item))
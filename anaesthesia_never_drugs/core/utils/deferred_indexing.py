@@ -0,0 +1,52 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+
+# Per-instance signal work can be deferred during bulk operations such as imports
+# Handlers record the primary keys they would have processed, and each sender's flush
+# function receives them together when the outermost deferred_indexing block exits
+
+_flush_functions = {}
+_state = threading.local()
+
+
+def register_flush(sender, flush_function):
+    '''Registers flush_function(ids) to process the deferred instances of sender'''
+    _flush_functions[sender] = flush_function
+
+
+def defer_instance(sender, pk):
+    '''
+    Records an instance if indexing is deferred in this thread
+    Returns True if the caller should skip its per-instance work
+    '''
+    touched = getattr(_state, 'touched', None)
+    if touched is None or sender not in _flush_functions:
+        return False
+    touched[sender].add(pk)
+    return True
+
+
+@contextmanager
+def deferred_indexing():
+    '''
+    Mutes registered per-instance signal handlers for the duration of the block
+    On a successful exit each sender's flush function is called once with the touched ids
+    Work recorded while flushing, such as Drugs created for ChemicalSubstances, is flushed in turn
+
+    Blocks may be nested; only the outermost block flushes
+    If the block raises, the recorded work is discarded with it
+    '''
+    if getattr(_state, 'touched', None) is not None:
+        yield
+        return
+
+    _state.touched = defaultdict(set)
+    try:
+        yield
+        while _state.touched:
+            touched, _state.touched = _state.touched, defaultdict(set)
+            for sender, ids in touched.items():
+                _flush_functions[sender](ids)
+    finally:
+        _state.touched = None
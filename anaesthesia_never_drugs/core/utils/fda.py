@@ -1,11 +1,12 @@
 import os
 import ijson
-import requests
 import zipfile
 import tempfile
 from datetime import datetime
 from collections import defaultdict
 
+from .http_archive import get_session
+
 url = 'https://api.fda.gov/download.json'
 
 def get_latest_json_path(url):
@@ -18,7 +19,7 @@ def get_latest_json_path(url):
     Returns:
     - dict: A dictionary containing the parts of the JSON to download and the export date.
     """
-    with requests.get(url) as r:
+    with get_session().get(url) as r:
         r.raise_for_status()
         download = r.json()
 
@@ -62,7 +63,7 @@ def stream_file_to_disk(url, directory, filename=None):
     os.makedirs(directory, exist_ok=True)
     path = os.path.join(directory, filename)
     
-    with requests.get(url, stream=True) as r:
+    with get_session().get(url, stream=True) as r:
         r.raise_for_status()
         with open(path, 'wb') as f:
             for chunk in r.iter_content(chunk_size=8192):
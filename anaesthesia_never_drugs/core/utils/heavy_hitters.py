@@ -0,0 +1,70 @@
+import hashlib
+
+# Streaming top-K of search queries in fixed memory
+# A Count-Min sketch estimates the count of every query seen
+# A sorted set holds the K queries with the highest estimates
+
+
+class HeavyHitters:
+    '''
+    Count-Min sketch plus a bounded sorted set, both stored in Redis
+
+    The sketch is a hash of depth * width counters, so its size does not grow with the number
+    of distinct queries. Estimates never undercount and overcount by at most
+    e / width of the total count with high probability.
+    '''
+    def __init__(self, redis_client, key, k=5000, width=16384, depth=4):
+        if depth > 8:
+            raise ValueError('A depth of at most 8 is supported')
+        self.redis_client = redis_client
+        self.sketch_key = f'{key}_sketch'
+        self.top_key = f'{key}_top'
+        self.k = k
+        self.width = width
+        self.depth = depth
+
+    def get_counter_fields(self, item):
+        '''Returns one sketch counter per row, derived from a single 32 byte digest'''
+        digest = hashlib.blake2b(item.encode(), digest_size=32).digest()
+        return [
+            f'{row}:{int.from_bytes(digest[row * 4:row * 4 + 4], "big") % self.width}'
+            for row in range(self.depth)
+        ]
+
+    def add_counts(self, counts):
+        '''
+        Adds a dictionary of item:count to the sketch and updates the top K
+        Uses two pipelined round trips regardless of the number of items
+        '''
+        if not counts:
+            return
+
+        items = list(counts.items())
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for item, count in items:
+            for field in self.get_counter_fields(item):
+                pipeline.hincrby(self.sketch_key, field, count)
+        results = pipeline.execute()
+
+        # The estimate is the smallest counter for each item
+        estimates = {
+            item: min(results[i * self.depth:(i + 1) * self.depth])
+            for i, (item, _) in enumerate(items)
+        }
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.zadd(self.top_key, estimates)
+        pipeline.zremrangebyrank(self.top_key, 0, -self.k - 1)  # Keep only the top K
+        pipeline.execute()
+
+    def estimate(self, item):
+        counters = self.redis_client.hmget(self.sketch_key, self.get_counter_fields(item))
+        return min(int(counter or 0) for counter in counters)
+
+    def top(self, n=None):
+        '''Returns a list of (item, estimated count), most frequent first'''
+        end = (n or self.k) - 1
+        return [
+            (item.decode(), int(count))
+            for item, count in self.redis_client.zrevrange(self.top_key, 0, end, withscores=True)
+        ]
@@ -1,3 +1,20 @@
+from django.conf import settings
+import redis
+
+_redis_client = None
+
+
+def get_redis_client():
+    '''
+    Returns a Redis client for the Celery broker
+    The client is shared within the process so its connection pool is reused
+    '''
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.StrictRedis.from_url(settings.CELERY_BROKER_URL)
+    return _redis_client
+
+
 def chunk_queryset(queryset, chunk_size=100):
     '''
     Given a queryset and a chunk size, returns a generator
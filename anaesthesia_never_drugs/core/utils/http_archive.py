@@ -0,0 +1,297 @@
+from django.conf import settings
+import gzip
+import hashlib
+import httpx
+import json
+import os
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+import tempfile
+import time
+
+from ..exceptions import ArchiveMissException
+
+# Record and replay of the HTTP traffic of the import pipelines
+# HTTP_ARCHIVE_MODE = 'record' captures every response into HTTP_ARCHIVE_PATH
+# HTTP_ARCHIVE_MODE = 'replay' serves them back without touching the network
+# so import throughput can be measured repeatably on an isolated machine
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+# Bodies are archived decoded, so transfer headers no longer describe them
+excluded_headers = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+# Conditional requests are recorded as full requests, so the archive never holds a bodiless 304
+conditional_headers = ('If-None-Match', 'If-Modified-Since')
+
+# Bodies are written and replayed in chunks, so large downloads are never held in memory
+CHUNK_SIZE = 64 * 1024
+
+
+def get_archive_mode():
+    mode = settings.HTTP_ARCHIVE_MODE or None
+    if mode not in (None, RECORD, REPLAY):
+        raise ValueError(f'HTTP_ARCHIVE_MODE must be {RECORD!r}, {REPLAY!r} or empty, not {mode!r}')
+    return mode
+
+
+class HttpArchive:
+    '''
+    Directory of recorded responses, keyed by method and URL
+    Each response is a JSON file of its status and headers and a gzipped body
+    Files are renamed into place, so concurrent Celery workers can record into one archive
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get_paths(self, method, url):
+        key = hashlib.sha256(f'{method.upper()} {url}'.encode()).hexdigest()
+        return os.path.join(self.path, f'{key}.json'), os.path.join(self.path, f'{key}.gz')
+
+    def writer(self, method, url, status_code, headers):
+        '''Returns an ArchiveWriter for a response whose body is still to be read'''
+        return ArchiveWriter(self, method, url, status_code, headers)
+
+    def store(self, method, url, status_code, headers, content):
+        '''Archives a response; headers is an iterable of (name, value) pairs'''
+        writer = self.writer(method, url, status_code, headers)
+        writer.write(content)
+        writer.commit()
+
+    def open(self, method, url):
+        '''Returns (metadata, body) for a recorded response; body is a file object of the decompressed content'''
+        metadata_path, body_path = self.get_paths(method, url)
+        try:
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            body = gzip.open(body_path, 'rb')
+        except FileNotFoundError:
+            raise ArchiveMissException(f'No recorded response for {method.upper()} {url}')
+        return metadata, body
+
+    def load(self, method, url):
+        '''Returns (metadata, content) for a recorded response'''
+        metadata, body = self.open(method, url)
+        with body:
+            return metadata, body.read()
+
+    def iter_responses(self):
+        '''Yields (metadata, content) for every recorded response'''
+        for filename in sorted(os.listdir(self.path)):
+            if filename.endswith('.json'):
+                with open(os.path.join(self.path, filename)) as f:
+                    metadata = json.load(f)
+                yield self.load(metadata['method'], metadata['url'])
+
+
+class ArchiveWriter:
+    '''
+    Compresses a response body into the archive as it is read
+    The response is only added to the archive by commit(); discard() drops a partial body
+    '''
+    def __init__(self, archive, method, url, status_code, headers):
+        self.metadata_path, self.body_path = archive.get_paths(method, url)
+        self.metadata = {
+            'method': method.upper(),
+            'url': url,
+            'status_code': status_code,
+            'headers': [(name, value) for name, value in headers if name.lower() not in excluded_headers],
+            'recorded_at': time.time(),
+        }
+        # A unique temporary file, as several workers may record the same URL
+        fd, self.tmp_path = tempfile.mkstemp(dir=archive.path, suffix='.tmp')
+        os.close(fd)
+        self.file = gzip.open(self.tmp_path, 'wb')
+        self.finished = False
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.file.close()
+        os.replace(self.tmp_path, self.body_path)
+        with open(f'{self.metadata_path}.tmp', 'w') as f:
+            json.dump(self.metadata, f)
+        os.replace(f'{self.metadata_path}.tmp', self.metadata_path)
+
+    def discard(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+def get_archive():
+    return HttpArchive(settings.HTTP_ARCHIVE_PATH)
+
+
+# requests
+
+class RecordingBody:
+    '''
+    Stands in for response.raw, archiving the decoded body as the caller reads it
+    The response is archived once the body has been read to the end
+    '''
+    def __init__(self, raw, writer):
+        self.raw = raw
+        self.writer = writer
+
+    def read(self, amt=None, **kwargs):
+        data = self.raw.read(amt, decode_content=True)
+        if data:
+            self.writer.write(data)
+        if not data or amt is None:
+            self.writer.commit()
+            self.raw.release_conn()
+        return data
+
+    def release_conn(self):
+        self.raw.release_conn()
+
+    def close(self):
+        self.writer.discard()  # Closed before the end of the body
+        self.raw.close()
+
+
+class ReplayBody:
+    '''Stands in for response.raw, reading a recorded body from the archive and closing it at the end'''
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, amt=None, **kwargs):
+        data = self.body.read(-1 if amt is None else amt)
+        if not data or amt is None:
+            self.body.close()
+        return data
+
+    def close(self):
+        self.body.close()
+
+
+class RecordingAdapter(HTTPAdapter):
+    '''Sends requests as normal and archives each response while its body is read'''
+    def __init__(self, archive, *args, **kwargs):
+        self.archive = archive
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        for header in conditional_headers:
+            request.headers.pop(header, None)
+        response = super().send(request, **kwargs)
+        writer = self.archive.writer(request.method, request.url, response.status_code, response.headers.items())
+        response.raw = RecordingBody(response.raw, writer)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    '''Answers every request from the archive'''
+    def __init__(self, archive):
+        self.archive = archive
+        super().__init__()
+
+    def send(self, request, **kwargs):
+        metadata, body = self.archive.open(request.method, request.url)
+        response = requests.Response()
+        response.status_code = metadata['status_code']
+        response.headers = CaseInsensitiveDict(metadata['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.raw = ReplayBody(body)  # Read in chunks by iter_content
+        return response
+
+    def close(self):
+        pass
+
+
+def get_session():
+    '''Returns a requests.Session that records or replays when HTTP_ARCHIVE_MODE is set'''
+    session = requests.Session()
+    mode = get_archive_mode()
+    if mode:
+        adapter = RecordingAdapter(get_archive()) if mode == RECORD else ReplayAdapter(get_archive())
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
+
+# httpx
+
+class RecordingStream(httpx.AsyncByteStream):
+    '''Passes on the decoded body of a response, archiving it as it is read'''
+    def __init__(self, response, writer):
+        self.response = response
+        self.writer = writer
+
+    async def __aiter__(self):
+        async for chunk in self.response.aiter_bytes():
+            self.writer.write(chunk)
+            yield chunk
+        self.writer.commit()
+
+    async def aclose(self):
+        self.writer.discard()  # Closed before the end of the body
+        await self.response.aclose()
+
+
+class ReplayStream(httpx.AsyncByteStream):
+    '''Reads a recorded body from the archive in chunks'''
+    def __init__(self, body):
+        self.body = body
+
+    async def __aiter__(self):
+        while chunk := self.body.read(CHUNK_SIZE):
+            yield chunk
+
+    async def aclose(self):
+        self.body.close()
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    '''Wraps a transport, archiving each response while its body is read'''
+    def __init__(self, archive, transport):
+        self.archive = archive
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        for header in conditional_headers:
+            request.headers.pop(header, None)
+        response = await self.transport.handle_async_request(request)
+        headers = [
+            (name, value) for name, value in response.headers.multi_items() if name.lower() not in excluded_headers
+        ]
+        writer = self.archive.writer(request.method, str(request.url), response.status_code, headers)
+        # The body is decoded by the wrapped response, so it is passed on without Content-Encoding
+        return httpx.Response(response.status_code, headers=headers, stream=RecordingStream(response, writer))
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    '''Answers every request from the archive'''
+    def __init__(self, archive):
+        self.archive = archive
+
+    async def handle_async_request(self, request):
+        metadata, body = self.archive.open(request.method, str(request.url))
+        return httpx.Response(metadata['status_code'], headers=metadata['headers'], stream=ReplayStream(body))
+
+
+def get_async_transport(**transport_options):
+    '''Returns an httpx transport that records or replays when HTTP_ARCHIVE_MODE is set'''
+    mode = get_archive_mode()
+    if mode == REPLAY:
+        return ReplayTransport(get_archive())
+    transport = httpx.AsyncHTTPTransport(**transport_options)
+    if mode == RECORD:
+        return RecordingTransport(get_archive(), transport)
+    return transport
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+import threading
+import time
+
+# A size-bounded cache held in the memory of each process
+# Used in front of the shared cache so hot keys are served without network I/O
+
+
+class LocalCache:
+    '''
+    Least recently used cache with a per-entry timeout
+    Safe to share between the threads of a worker
+    '''
+    def __init__(self, maxsize=1000, timeout=300):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.entries = OrderedDict()  # key: (expires_at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=-1):
+        '''Stores a value; a timeout of None never expires, and -1 uses the default timeout'''
+        timeout = self.timeout if timeout == -1 else timeout
+        expires_at = None if timeout is None else time.monotonic() + timeout
+
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Search rankings, keyed by SearchIndex generation and query
+search_cache = LocalCache(maxsize=1000, timeout=300)
+
+# Small values read on most requests, such as the SearchIndex generation and latest imports
+lookup_cache = LocalCache(maxsize=100, timeout=60)
+
+# Queries known to have no results, kept briefly so repeated typos skip the database
+# Held apart from search_cache so that they cannot evict useful results
+negative_search_cache = LocalCache(maxsize=5000, timeout=60)
+
+# The lexemes Postgres stems each query word to, which only change with the text search configuration
+lexeme_cache = LocalCache(maxsize=10000, timeout=None)
@@ -0,0 +1,32 @@
+import hashlib
+import unicodedata
+
+# Normalisation of user search queries
+# Applied before search queries are cached or logged, so equivalent queries share an entry
+
+MAX_QUERY_LENGTH = 100
+
+
+def normalise_query(query):
+    '''
+    Returns a canonical form of a search query
+    - Unicode NFKC, so compatibility characters such as full-width letters are folded
+    - Accents removed
+    - Punctuation, symbols and control characters replaced by spaces
+    - Case folded, with whitespace trimmed and collapsed
+    - Truncated to MAX_QUERY_LENGTH characters
+    '''
+    query = unicodedata.normalize('NFKC', query or '')
+
+    # Remove accents by dropping combining marks from the decomposed form
+    query = ''.join(char for char in unicodedata.normalize('NFKD', query) if not unicodedata.combining(char))
+
+    query = ''.join(' ' if unicodedata.category(char)[0] in 'PSZC' else char for char in query)
+    query = ' '.join(query.casefold().split())
+
+    return unicodedata.normalize('NFC', query)[:MAX_QUERY_LENGTH].strip()
+
+
+def hash_query(query):
+    '''Returns a fixed length digest of a normalised query, for use in cache keys'''
+    return hashlib.sha1(query.encode()).hexdigest()
@@ -1,11 +1,11 @@
-import requests
+from .http_archive import get_session
 
 def get_latest_orphanet_json():
     
     url = 'https://api.orphacode.org/EN/ClinicalEntity'
     headers = {'Apikey': 'test4'}
     
-    with requests.get(url, headers=headers) as r:
+    with get_session().get(url, headers=headers) as r:
         
         r.raise_for_status()
         download = r.json()
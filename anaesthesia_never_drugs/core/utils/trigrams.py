@@ -0,0 +1,26 @@
+import re
+
+# Python equivalents of the pg_trgm trigram functions
+# Used to score small result sets in memory without a round trip to Postgres
+
+word_pattern = re.compile(r'[^\W_]+')  # pg_trgm treats non-alphanumerics as word boundaries
+
+
+def get_trigrams(text):
+    '''
+    Returns the set of trigrams pg_trgm would extract from text
+    Each lowercased word is padded with two spaces before and one after
+    '''
+    trigrams = set()
+    for word in word_pattern.findall((text or '').lower()):
+        padded = f'  {word} '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def similarity(text, query):
+    '''Equivalent to pg_trgm similarity(): shared trigrams over all distinct trigrams'''
+    text_trigrams = get_trigrams(text)
+    query_trigrams = get_trigrams(query)
+    union = len(text_trigrams | query_trigrams)
+    return len(text_trigrams & query_trigrams) / union if union else 0.0
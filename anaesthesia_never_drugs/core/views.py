@@ -1,21 +1,103 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render
-from django.http import HttpResponseNotAllowed
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
+import hashlib
 
-from .models.search import SearchIndex
+from .models.search import SearchIndex, SearchPage, SearchQueryLog
+from .utils.autocomplete import autocomplete, is_autocomplete_query
+from .utils.local_cache import negative_search_cache
+from .utils.normalise import normalise_query
 
 
+def get_page_size(request):
+    try:
+        page_size = int(request.GET.get('page_size', SearchIndex.PAGE_SIZE))
+    except ValueError:
+        return SearchIndex.PAGE_SIZE
+    return max(1, min(page_size, SearchIndex.MAX_PAGE_SIZE))
+
+
+def get_search_version(request):
+    '''
+    Identifies a rendered search response by SearchIndex generation, query, page and request type
+    The generation counts changes to the index: it is advanced when imports activate, when the
+    drain rewrites rows, and when rows are saved or deleted directly
+    Short prefixes use the generation the autocomplete index was built from, as it is rebuilt in the background
+    '''
+    query = normalise_query(request.GET.get('q'))
+    if is_autocomplete_query(query):
+        generation = autocomplete.get_generation()
+    else:
+        generation = SearchIndex.get_generation()
+
+    parts = [
+        query,
+        request.GET.get('page', ''),
+        request.GET.get('page_size', ''),
+        'partial' if request.headers.get('HX-Request') else 'page',
+    ]
+    digest = hashlib.md5('\x1f'.join(parts).encode()).hexdigest()
+    return f'{generation}-{digest}'
+
+
+def get_search_context(request):
+    # Get the search query and a page of results
+    query = request.GET.get('q')
+    page_token = request.GET.get('page')
+    normalised_query = normalise_query(query)
+    if is_autocomplete_query(normalised_query):
+        # Short prefixes are matched and rendered from memory
+        results = autocomplete.lookup(normalised_query)
+        page = SearchPage(results, None, len(results))
+    else:
+        page = SearchIndex.search_page(query, page_size=get_page_size(request), page_token=page_token)
+
+    return {
+        'query': query,
+        'results': page.results,
+        'next_page_token': page.next_page_token,
+        'estimated_total': page.estimated_total,
+        'approximate': page.approximate,
+    }
+
+
+@vary_on_headers('HX-Request')
+@condition(etag_func=get_search_version)
 def search(request):
     # Only handle GET requests
     if request.method != "GET":
         return HttpResponseNotAllowed(['GET'])
 
-    # Get the search query and results
-    query = request.GET.get('q')
-    results = SearchIndex.search(query)
-
     if request.headers.get('HX-Request'):
         # If the request is an HTMX request, return only the results part
-        return render(request, 'search/partials/search_results.html', {'results': results})
+        # Rendered partials are cached, so a repeat query does no ORM or template work
+        fragment_key = f'search_fragment_{get_search_version(request)}'
+        content = cache.get(fragment_key)
+
+        if content is None:
+            context = get_search_context(request)
+            content = render_to_string('search/partials/search_results.html', context, request=request)
+            # "No results" is kept no longer than a negative search result
+            # Rankings reused from a prefix stay in this process and are not shared
+            timeout = settings.SEARCH_CACHE_TIMEOUT if context['results'] else negative_search_cache.timeout
+            if not context['approximate']:
+                cache.set(fragment_key, content, timeout=timeout)
+        else:
+            # Keep counting searches served from the fragment cache
+            query = normalise_query(request.GET.get('q'))
+            if query and not request.GET.get('page') and not is_autocomplete_query(query):
+                SearchQueryLog.log_query(query)
+
+        response = HttpResponse(content)
+    else:
+        # Assemble the context dictionary
+        response = render(request, 'search/search_results.html', get_search_context(request))
 
-    # Assemble the context dictionary
-    return render(request, 'search/search_results.html', {'results': results})
+    # Browsers revalidate with If-None-Match and reuse their copy on a 304
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -23,4 +23,20 @@ app.conf.beat_schedule = {
         'task': 'anaesthesia_never_drugs.core.tasks.cache_common_queries',
         'schedule': crontab(minute=0, hour='*'),  # Run at the start of every hour
     },
+    'flush-search-query-log': {
+        'task': 'anaesthesia_never_drugs.core.tasks.flush_search_query_log',
+        'schedule': crontab(minute='*'),  # Run every minute
+    },
+    'drain-search-index-updates': {
+        'task': 'anaesthesia_never_drugs.core.tasks.drain_search_index_updates',
+        'schedule': crontab(minute='*'),  # Run every minute
+    },
+    'reconcile-search-index': {
+        'task': 'anaesthesia_never_drugs.core.tasks.reconcile_search_index',
+        'schedule': crontab(minute=15, hour=3),  # Run daily at 03:15
+    },
+    'persist-top-search-queries': {
+        'task': 'anaesthesia_never_drugs.core.tasks.persist_top_search_queries',
+        'schedule': crontab(minute=30, hour='*'),  # Run at half past every hour
+    },
 }
\ No newline at end of file
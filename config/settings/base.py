@@ -67,6 +67,7 @@ DJANGO_APPS = [
     "django.contrib.staticfiles",
     # "django.contrib.humanize", # Handy template tags
     "django.contrib.admin",
+    "django.contrib.postgres",
     "django.forms",
 ]
 THIRD_PARTY_APPS = [
@@ -325,3 +326,27 @@ WEBPACK_LOADER = {
 }
 # Your stuff...
 # ------------------------------------------------------------------------------
+
+# Search
+# ------------------------------------------------------------------------------
+# Search cache keys include the SearchIndex generation, so entries can live for a long time
+SEARCH_CACHE_TIMEOUT = env.int('SEARCH_CACHE_TIMEOUT', default=60 * 60 * 24 * 7)  # 7 days
+
+# WHO ATC scraping
+# ------------------------------------------------------------------------------
+# Politeness limits for the concurrent crawler: requests started per second,
+# and requests outstanding at once
+ATC_REQUESTS_PER_SECOND = env.float('ATC_REQUESTS_PER_SECOND', default=1.0)
+ATC_MAX_IN_FLIGHT = env.int('ATC_MAX_IN_FLIGHT', default=4)
+ATC_PARSE_WORKERS = env.int('ATC_PARSE_WORKERS', default=2)
+# Pages are cached on disk and revalidated with conditional requests
+# Children of unchanged pages are trusted without a request for ATC_HTTP_CACHE_MAX_AGE seconds
+ATC_HTTP_CACHE_DIR = env('ATC_HTTP_CACHE_DIR', default=str(BASE_DIR / '.cache' / 'atc'))
+ATC_HTTP_CACHE_MAX_AGE = env.int('ATC_HTTP_CACHE_MAX_AGE', default=60 * 60 * 24 * 7)
+
+# HTTP archive
+# ------------------------------------------------------------------------------
+# 'record' captures the responses of the import pipelines into HTTP_ARCHIVE_PATH,
+# 'replay' serves them back without network access, for offline benchmarking
+HTTP_ARCHIVE_MODE = env('HTTP_ARCHIVE_MODE', default='')
+HTTP_ARCHIVE_PATH = env('HTTP_ARCHIVE_PATH', default=str(BASE_DIR / '.cache' / 'http_archive'))